@@ -1,30 +1,98 @@
 from __future__ import print_function
-import re
+import re, threading
+from collections import OrderedDict
+from itertools import islice
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
 
-class CommandHistory:
+def folds_like_re(string):
     """
-    Handle all things related to managing and navigating the command history
+    Tell whether lower() folds the case of string the way re.IGNORECASE
+    does. This holds for the ASCII and the uncased characters; the other
+    ones can have equivalences that lower() misses (e.g. 'ſ' matches 's'
+    and 'ı' matches 'i').
+    """
+    if not string or max(string) <= '\x7f':
+        # ASCII
+        return True
+    return not any(c > '\x7f' and (c.lower() != c or c.upper() != c) for c in string)
+
+
+class HistoryIndex(object):
+    """
+    Trigram inverted index over the lines of the command history, used to
+    quickly narrow down the lines that can possibly match a search filter
     """
     def __init__(self):
-        # The actual command list
-        self.list = []
+        # Map trigram (lowercase) --> set of lines containing it
+        self.postings = {}
 
-        # The current search filter
-        self.filter = ''
+        # Lines that lower() can't fold like the matcher (see folds_like_re()):
+        # they are candidates for every search
+        self.unindexed = set()
 
-        # A filtered list based on the current filter
-        self.filtered_list = []
+    @staticmethod
+    def trigrams(string):
+        """Return the set of (lowercase) trigrams of a string"""
+        string = string.lower()
+        return set([string[i : i + 3] for i in range(len(string) - 2)])
 
-        # A trail of visited indices (while navigating)
-        self.trail = []
+    def add(self, line):
+        """Index a new line"""
+        if not folds_like_re(line):
+            self.unindexed.add(line)
+            return
+        for trigram in self.trigrams(line):
+            self.postings.setdefault(trigram, set()).add(line)
 
-    def start(self, line):
+    def remove(self, line):
+        """Drop a line from the index"""
+        if not folds_like_re(line):
+            self.unindexed.discard(line)
+            return
+        for trigram in self.trigrams(line):
+            lines = self.postings.get(trigram)
+            if lines is not None:
+                lines.discard(line)
+                if not lines:
+                    del self.postings[trigram]
+
+    def clear(self):
+        """Drop all the indexed lines"""
+        self.postings = {}
+        self.unindexed = set()
+
+    def candidates(self, substrings):
         """
-        Start history navigation
+        Return the set of lines that contain all of the given substrings
+        (ignoring case), or None if the substrings are too short to restrict
+        the search. The result is a superset of the actual matches, as the
+        trigrams of a substring might occur in a line at different positions.
         """
-        #print('\n\nStart\n\n')
-        self.filter = line
+        if not all(folds_like_re(s) for s in substrings):
+            return None
+        result = None
+        for trigram in set().union(*[self.trigrams(s) for s in substrings]):
+            lines = self.postings.get(trigram, set())
+            if result is None:
+                result = set(lines)
+            else:
+                result &= lines
+            if not result:
+                break
+        if result is not None:
+            result |= self.unindexed
+        return result
 
+
+class HistoryMatcher(object):
+    """
+    Match history lines against the tiers of regex patterns derived from a
+    search filter; the lower the tier of a match, the stronger the match
+    """
+    def __init__(self, line):
         # Create a list of regex patterns to use when navigating the history
         # using a filter
         # A. First use just the space as word separator; these are the most
@@ -41,7 +109,10 @@ class CommandHistory:
         ]
 
         # B. Then split based on other separator characters as well
-        words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)] # Split the filter into words
+        words = re.findall('[a-zA-Z0-9]+', line)  # Split the filter into words
+        # Every pattern below requires all these words to be present
+        self.required = words
+        words = [re.escape(w) for w in words]
         boundary = '[\\s\\.\\-\\\\_]+'   # Word boundary characters
         patterns += [
             # Prefixes match for each word in the command (strongest, these will be the
@@ -66,25 +137,392 @@ class CommandHistory:
             # simple (one-word) filters -- this saves a lot of computation effort
             # as these filters will yield a long list of matched lines!
             patterns = [patterns[4]]
+            self.required = [line]
+
+        # With at most one word, only the exact string match is used
+        self.simple = len(words) <= 1
+        self.filter = line
+
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in patterns]
+
+    def match(self, line):
+        """
+        Return the (tier, spans) of the strongest pattern matching the line,
+        or None if the line doesn't match
+        """
+        # Any line matched by a stronger pattern is also matched by the
+        # weakest one, so most non-matching lines are discarded right away
+        matches = self.patterns[-1].search(line)
+        if not matches:
+            return None
+        tier = len(self.patterns) - 1
+        for stronger_tier, pattern in enumerate(self.patterns[:-1]):
+            stronger_matches = pattern.search(line)
+            if stronger_matches:
+                (tier, matches) = (stronger_tier, stronger_matches)
+                break
+        return (tier, [matches.span(i) for i in range(1, matches.lastindex + 1)])
+
+
+class PrefixTree(object):
+    """
+    Compressed prefix tree (radix tree) over the history lines; each node
+    tracks the most recent line below it, so the most recent line starting
+    with a given prefix is found in time proportional to the prefix length
+    """
+    class Node(object):
+        __slots__ = ['label', 'children', 'stamp', 'best']
+
+        def __init__(self, label):
+            # Characters on the edge leading to this node
+            self.label = label
+            # Map first character of the label --> child node
+            self.children = {}
+            # Stamp of the line ending at this node (None if no line ends here)
+            self.stamp = None
+            # (stamp, line) of the most recent line below this node
+            self.best = None
+
+    def __init__(self):
+        self.root = self.Node('')
+
+    def add(self, line, stamp):
+        """Add a line with the given stamp (higher is more recent)"""
+        entry = (stamp, line)
+        node = self.root
+        node.best = max(node.best, entry) if node.best else entry
+        pos = 0
+        while pos < len(line):
+            child = node.children.get(line[pos])
+            if child is None:
+                child = self.Node(line[pos:])
+                node.children[line[pos]] = child
+            else:
+                common = 0
+                while (common < len(child.label) and pos + common < len(line)
+                       and child.label[common] == line[pos + common]):
+                    common += 1
+                if common < len(child.label):
+                    # Split the edge
+                    middle = self.Node(child.label[:common])
+                    middle.best = child.best
+                    child.label = child.label[common:]
+                    middle.children[child.label[0]] = child
+                    node.children[line[pos]] = middle
+                    child = middle
+            pos += len(child.label)
+            node = child
+            node.best = max(node.best, entry) if node.best else entry
+        node.stamp = stamp
+
+    def remove(self, line):
+        """Remove a line from the tree"""
+        path = [(None, self.root, 0)]
+        node = self.root
+        pos = 0
+        while pos < len(line):
+            child = node.children.get(line[pos])
+            if child is None or not line.startswith(child.label, pos):
+                return
+            pos += len(child.label)
+            path.append((node, child, pos))
+            node = child
+        if node.stamp is None:
+            return
+        node.stamp = None
+
+        # Update the most recent lines bottom-up, prune the unneeded nodes
+        for (parent, node, pos) in reversed(path):
+            entries = [child.best for child in node.children.values()]
+            if node.stamp is not None:
+                entries.append((node.stamp, line[:pos]))
+            node.best = max(entries) if entries else None
+            if parent is None or node.stamp is not None:
+                continue
+            if not node.children:
+                del parent.children[node.label[0]]
+            elif len(node.children) == 1:
+                # Merge with the only child
+                (child,) = node.children.values()
+                node.label += child.label
+                node.children = child.children
+                node.stamp = child.stamp
+
+    def latest(self, prefix):
+        """Return the most recent line starting with prefix (None if no such line)"""
+        node = self.root
+        pos = 0
+        while pos < len(prefix):
+            child = node.children.get(prefix[pos])
+            if child is None:
+                return None
+            if child.label.startswith(prefix[pos : pos + len(child.label)]):
+                if pos + len(child.label) >= len(prefix):
+                    # The prefix ends on this edge
+                    return child.best[1]
+                pos += len(child.label)
+                node = child
+            else:
+                return None
+        return node.best[1] if node.best else None
+
+
+class HistoryView(Sequence):
+    """
+    Read-only, list-like view of the history lines (oldest first); membership
+    tests and access to the most recent lines don't scan the whole history
+    """
+    def __init__(self, lines):
+        self._lines = lines
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines)
+
+    def __reversed__(self):
+        return reversed(self._lines)
+
+    def __contains__(self, line):
+        return line in self._lines
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self._lines)
+        if index < 0 or index >= len(self._lines):
+            raise IndexError('history index out of range')
+        if index >= len(self._lines) // 2:
+            # Walk from the most recent end
+            lines = reversed(self._lines)
+            index = len(self._lines) - 1 - index
+        else:
+            lines = iter(self._lines)
+        return next(islice(lines, index, None))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
 
-        # Traverse the history and build the filtered list
+class CommandHistory(object):
+    """
+    Handle all things related to managing and navigating the command history
+    """
+    # Lists longer than this are indexed on a background thread
+    background_index_size = 1000
+
+    # Number of lines the background thread indexes at a time
+    index_chunk_size = 200
+
+    def __init__(self, lazy=True):
+        # The actual commands (oldest first), mapped to their insertion stamp
+        # (higher is more recent)
+        self._lines = OrderedDict()
+        self._next_stamp = 0
+
+        # Lazy mode: find the matches of a search only as they are navigated to
+        self.lazy = lazy
+
+        # Inverted index and prefix tree over the history lines, kept in step
+        # with the list. Long lists are indexed in the background (see
+        # _build_indexes()), until then the lines are scanned instead.
+        self._index = HistoryIndex()
+        self._prefixes = PrefixTree()
+        self._indexed = True
+        self._indexer = None
+
+        # Serializes the changes to the lines and indexes with the indexer
+        self._index_lock = threading.Lock()
+
+        # The current search filter
+        self.filter = ''
+
+        # A filtered list based on the current filter (in lazy mode, only the
+        # matches found so far that were not navigated to yet)
         self.filtered_list = []
-        for pattern in patterns:
-            #print('\n\n', pattern, '\n\n')
-            for line in reversed(self.list):
-                if line in [l for (l, p) in self.filtered_list]:
-                    # We already added this line, skip
-                    continue
-                # No need to re.compile() this, the re library automatically caches compiled
-                # versions of the recently used expressions
-                matches = re.search(pattern, line, re.IGNORECASE)
-                if matches:
-                    self.filtered_list.insert(0, (line, [matches.span(i) for i in range(1, matches.lastindex + 1)]))
-                    #print('\n\n', self.filtered_list[-1], '\n\n')
+
+        # Generator of the matches not found yet (lazy mode)
+        self._pending = None
+
+        # The matcher and the matched lines (most recent first) of the last
+        # search, used to narrow down the search when the filter is refined
+        self._last_matcher = None
+        self._last_matches = []
+
+        # A trail of visited indices (while navigating)
+        self.trail = []
+
+    @property
+    def list(self):
+        """The actual command list (oldest first)"""
+        return HistoryView(self._lines)
+
+    @list.setter
+    def list(self, lines):
+        lines = list(lines)
+        stamps = range(self._next_stamp, self._next_stamp + len(lines))
+        self._next_stamp += len(lines)
+        with self._index_lock:
+            # A running indexer stops when it sees the new index
+            self._lines = OrderedDict(zip(lines, stamps))
+            if len(self._lines) < len(lines):
+                # Duplicates, keep the most recent ones
+                self._lines = OrderedDict()
+                for (stamp, line) in zip(stamps, lines):
+                    self._lines.pop(line, None)
+                    self._lines[line] = stamp
+            self._index = HistoryIndex()
+            self._prefixes = PrefixTree()
+            self._indexed = len(self._lines) <= self.background_index_size
+        self._forget_search()
+        self.reset()
+
+        entries = list(self._lines.items())
+        if self._indexed:
+            self._build_indexes(self._index, self._prefixes, entries)
+        else:
+            self._indexer = threading.Thread(target=self._build_indexes,
+                                             args=(self._index, self._prefixes, entries),
+                                             name='HistoryIndexer')
+            self._indexer.daemon = True
+            self._indexer.start()
+
+    def _build_indexes(self, index, prefixes, entries):
+        """
+        Add the (line, stamp) entries to the index and prefix tree, a chunk at
+        a time; the lines added or removed meanwhile are skipped (_append()
+        and zap() take care of them), and the indexing stops if the list gets
+        replaced
+        """
+        for start in range(0, len(entries), self.index_chunk_size):
+            with self._index_lock:
+                if index is not self._index:
+                    return
+                for (line, stamp) in entries[start : start + self.index_chunk_size]:
+                    if self._lines.get(line) == stamp:
+                        index.add(line)
+                        prefixes.add(line, stamp)
+        with self._index_lock:
+            if index is self._index:
+                self._indexed = True
+
+    def _append(self, line):
+        """Make line the most recent one (moving it if already present)"""
+        with self._index_lock:
+            if self._lines.pop(line, None) is None or not self._indexed:
+                self._index.add(line)
+            self._lines[line] = self._next_stamp
+            self._prefixes.add(line, self._next_stamp)
+            self._next_stamp += 1
+
+    def latest(self, prefix):
+        """Return the most recent line starting with prefix (None if no such line)"""
+        if self._indexed:
+            return self._prefixes.latest(prefix)
+        # Still indexing
+        for line in reversed(self._lines):
+            if line.startswith(prefix):
+                return line
+        return None
+
+    def _candidates(self, substrings):
+        """
+        Return the lines that might contain all the given substrings, most
+        recent first
+        """
+        if not self._indexed:
+            return reversed(self._lines)
+        lines = self._index.candidates(substrings)
+        if lines is None:
+            return reversed(self._lines)
+        return sorted(lines, key=self._lines.__getitem__, reverse=True)
+
+    def start(self, line):
+        """
+        Start history navigation
+        """
+        #print('\n\nStart\n\n')
+        self.filter = line
+        matcher = HistoryMatcher(line)
+
+        if self._narrows(matcher):
+            # The filter was refined, the new matches are among the old ones
+            candidates = self._last_matches
+        else:
+            # Only look at the lines that the index reports as possible matches
+            candidates = self._candidates(matcher.required)
+        if isinstance(candidates, list):
+            # Until the search completes, the candidates can be used to narrow
+            # down a refined search
+            self._last_matcher = matcher
+            self._last_matches = candidates
+        else:
+            self._forget_search()
+
+        self.filtered_list = []
+        self._pending = self._search(matcher, candidates)
+        if not self.lazy:
+            # Find all the matches right away
+            self.filtered_list = list(self._pending)
+            self.filtered_list.reverse()
+            self._pending = None
 
         # We use the trail to navigate back in the same order
         self.trail = [(self.filter, [(0, len(self.filter))])]
 
+    def _search(self, matcher, candidates):
+        """
+        Generate the matches of a search in navigation order, strongest and
+        most recent first. The strongest matches are generated as soon as they
+        are found, the weaker ones once all the candidates are scanned.
+        """
+        # Evaluate each candidate line once, then bucket-sort the matches by
+        # their tier (most recent first within a tier)
+        buckets = [[] for pattern in matcher.patterns]
+        matched = []
+        for line in candidates:
+            match = matcher.match(line)
+            if match:
+                (tier, spans) = match
+                matched.append(line)
+                if tier == 0:
+                    yield (line, spans)
+                else:
+                    buckets[tier].append((line, spans))
+        self._last_matcher = matcher
+        self._last_matches = matched
+
+        for bucket in buckets[1:]:
+            for entry in bucket:
+                yield entry
+
+    def _narrows(self, matcher):
+        """
+        Check whether matcher only matches lines already matched during the
+        last search (and the history hasn't changed meanwhile)
+        """
+        last = self._last_matcher
+        # A line matching an extended filter contains the extended string
+        # (single-word filters) or the extended words in the same order
+        # (multiple-word filters), so it also matched the original filter. This
+        # doesn't hold when a single-word filter becomes a multiple-word one.
+        return (last is not None
+                and matcher.filter.startswith(last.filter)
+                and matcher.simple == last.simple)
+
+    def _forget_search(self):
+        """Drop the cached matches of the last search"""
+        self._last_matcher = None
+        self._last_matches = []
+
     def up(self):
         """
         Navigate back in the command history
@@ -92,7 +530,12 @@ class CommandHistory:
         if self.filtered_list:
             self.trail.append(self.filtered_list.pop())
             return True
+        entry = next(self._pending, None) if self._pending else None
+        if entry is not None:
+            self.trail.append(entry)
+            return True
         else:
+            self._pending = None
             return False
 
     def down(self):
@@ -109,23 +552,27 @@ class CommandHistory:
         """
         Zap current entry out of the history list
         """
-        if line in self.list:
-            self.list.remove(line)
+        if line in self._lines:
+            with self._index_lock:
+                del self._lines[line]
+                self._index.remove(line)
+                self._prefixes.remove(line)
+            self._forget_search()
         self.reset()
 
     def reset(self):
         """Reset browsing through the history"""
         self.filter = ''
         self.filtered_list = []
+        self._pending = None
         self.trail = []
 
     def add(self, line):
         """Add a new line to the history"""
         if line:
             #print('Adding "' + line + '"')
-            if line in self.list:
-                self.list.remove(line)
-            self.list.append(line)
+            self._append(line)
+            self._forget_search()
             self.reset()
 
     def current(self):
@@ -0,0 +1,215 @@
+import os, time, threading, sqlite3
+from HistoryFile import HistoryFile, REMOVE_MARKER
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    command TEXT NOT NULL,
+    timestamp REAL,
+    cwd TEXT,
+    exit_code INTEGER,
+    duration REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS history_command ON history (command);
+CREATE INDEX IF NOT EXISTS history_cwd ON history (cwd);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER
+);
+"""
+
+def _io_errors(method):
+    """Report the database errors as IOError, like the file backend"""
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except sqlite3.Error as error:
+            raise IOError(str(error))
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class Transaction(object):
+    """
+    Run a block in a transaction that locks the database for writing from
+    the start, so that no other instance can modify it between our reads
+    and writes
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.db.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class HistoryDatabase(object):
+    """
+    Persist a history (commands, directories) in an SQLite database, along
+    with the time, directory, exit code and duration of each command.
+
+    Same interface as HistoryFile: the unique index on the command text
+    takes care of the duplicates (adding a line again moves it to the end)
+    and the history is truncated by deleting the oldest rows, so nothing is
+    ever rewritten. An existing history file is imported on first use.
+    """
+    # Time (seconds) to wait for the other instances to release the database
+    lock_timeout = 30
+
+    def __init__(self, filename, length, fsync=False):
+        # The plain history file this database replaces
+        self.filename = filename
+        self.database = filename + '.db'
+
+        # Maximum number of lines to keep
+        self.length = length
+
+        # Sync each transaction to the disk (otherwise, a power loss can
+        # lose the last ones, but never corrupts the database)
+        self.fsync = fsync
+
+        # Id of the last row read, and the number of removals at that time
+        # (None if not read yet)
+        self.last_id = None
+        self.removals = None
+
+        # Lines added by other instances, not yet returned by update();
+        # None if lines were removed and the history must be reloaded
+        self.incoming = []
+
+        # Serializes the threads using this instance (main, history writer)
+        self.mutex = threading.Lock()
+        self.connection = None
+
+    def exists(self):
+        """Tell whether there is a history to read"""
+        return os.path.isfile(self.database) or os.path.isfile(self.filename)
+
+    @_io_errors
+    def read(self):
+        """Return the list of lines (oldest first)"""
+        with self.mutex:
+            db = self._connect()
+            self._replay(db)
+            self.incoming = []
+            query = 'SELECT command FROM history ORDER BY id DESC'
+            if self.length is not None:
+                query += ' LIMIT %d' % self.length
+            lines = [row[0] for row in db.execute(query)]
+            lines.reverse()
+            return lines
+
+    @_io_errors
+    def update(self):
+        """
+        Return the lines added by other instances since the last call (in
+        order); return None if some lines were removed in the meantime --
+        read() returns the new history
+        """
+        with self.mutex:
+            self._replay(self._connect())
+            incoming = self.incoming
+            self.incoming = []
+            return incoming
+
+    def add(self, line, info=None):
+        """
+        Add a line (moves it to the end if already present); info is a
+        dictionary with the timestamp, cwd, exit_code and duration of the
+        command
+        """
+        self.append([line], info={line: info} if info else None)
+
+    def remove(self, line):
+        """Remove a line"""
+        self.append([REMOVE_MARKER + line])
+
+    @_io_errors
+    def append(self, records, fsync=False, info=None):
+        """
+        Apply add/remove records (see HistoryFile) in a single transaction;
+        info maps the added lines to their command information. The fsync
+        argument is ignored, see the constructor.
+        """
+        with self.mutex:
+            db = self._connect()
+            with Transaction(db):
+                # Catch up with the other instances first, so that our own
+                # lines are not returned by update()
+                self._replay(db)
+                removed = False
+                for record in records:
+                    if record.startswith(REMOVE_MARKER):
+                        db.execute('DELETE FROM history WHERE command = ?',
+                                   (record[len(REMOVE_MARKER):],))
+                        removed = True
+                    else:
+                        command_info = info.get(record) if info else None
+                        command_info = command_info or {}
+                        db.execute('INSERT OR REPLACE INTO history'
+                                   ' (command, timestamp, cwd, exit_code, duration)'
+                                   ' VALUES (?, ?, ?, ?, ?)',
+                                   (record,
+                                    command_info.get('timestamp', time.time()),
+                                    command_info.get('cwd'),
+                                    command_info.get('exit_code'),
+                                    command_info.get('duration')))
+                        if self.incoming:
+                            # Keep the order of the database when the
+                            # others' lines are merged
+                            self.incoming.append(record)
+                if removed:
+                    db.execute('UPDATE meta SET value = value + 1 WHERE key = ?', ('removals',))
+                    self.removals += 1
+                if self.length is not None:
+                    # The truncated lines are still in the current session,
+                    # no need to report them
+                    db.execute('DELETE FROM history WHERE id <='
+                               ' (SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                               (self.length,))
+                self.last_id = self._last_id(db)
+
+    def _connect(self):
+        """Open the database (create it if needed)"""
+        if self.connection is None:
+            db = sqlite3.connect(self.database, timeout=self.lock_timeout, check_same_thread=False,
+                                 isolation_level=None)
+            db.execute('PRAGMA synchronous = ' + ('FULL' if self.fsync else 'NORMAL'))
+            with Transaction(db):
+                for statement in SCHEMA.split(';'):
+                    db.execute(statement)
+                db.execute('INSERT OR IGNORE INTO meta VALUES (?, 0)', ('removals',))
+                if (db.execute('INSERT OR IGNORE INTO meta VALUES (?, 1)', ('imported',)).rowcount
+                    and os.path.isfile(self.filename)):
+                    # Import the history file written by the file backend
+                    db.executemany('INSERT OR REPLACE INTO history (command) VALUES (?)',
+                                   [(l,) for l in HistoryFile(self.filename, self.length).read()])
+            self.connection = db
+        return self.connection
+
+    def _last_id(self, db):
+        return db.execute('SELECT ifnull(max(id), 0) FROM history').fetchone()[0]
+
+    def _replay(self, db):
+        """Collect the lines added by other instances since the last read"""
+        removals = db.execute('SELECT value FROM meta WHERE key = ?', ('removals',)).fetchone()[0]
+        if self.last_id is None:
+            self.last_id = self._last_id(db)
+        elif removals != self.removals:
+            self.incoming = None
+            self.last_id = self._last_id(db)
+        else:
+            rows = db.execute('SELECT id, command FROM history WHERE id > ? ORDER BY id',
+                              (self.last_id,)).fetchall()
+            if rows:
+                self.last_id = rows[-1][0]
+                if self.incoming is not None:
+                    self.incoming.extend([command for (_, command) in rows])
+                    if self.length is not None and len(self.incoming) > self.length:
+                        # Nobody is picking them up, reloading will be cheaper
+                        self.incoming = None
+        self.removals = removals
@@ -0,0 +1,332 @@
+import os, sys, codecs, time, threading
+from collections import OrderedDict
+
+if sys.version_info[0] == 2:
+    from Queue import Queue, Empty
+else:
+    from queue import Queue, Empty
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+# Records starting with this character remove a line from the history; other
+# records add (or move to the end) a line. NUL can't be part of a command, and
+# history files written before journaling load as a list of "add" records.
+REMOVE_MARKER = u'\0'
+
+class FileLock(object):
+    """
+    Exclusive lock shared by all the processes using a file; the lock is
+    held on a separate file (the history file itself gets replaced when
+    compacted), which also counts the rewrites of the locked file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def __enter__(self):
+        self.file = os.fdopen(os.open(self.filename,
+                                      os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)),
+                              'r+b')
+        if msvcrt:
+            self.file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except (IOError, OSError):
+                    # LK_LOCK gives up after ~10 seconds, keep waiting
+                    pass
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if msvcrt:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def generation(self):
+        """Return the number of rewrites of the locked file (the lock is held)"""
+        self.file.seek(0)
+        data = self.file.read().strip()
+        return int(data) if data.isdigit() else 0
+
+    def rewritten(self):
+        """Count a rewrite of the locked file, return the new generation"""
+        generation = self.generation() + 1
+        self.file.seek(0)
+        self.file.write(str(generation).encode('ascii'))
+        self.file.truncate()
+        self.file.flush()
+        return generation
+
+
+class HistoryFile(object):
+    """
+    Persist a history (commands, directories) as an append-only journal of
+    add/remove records; the journal is periodically compacted back to the
+    plain list of lines.
+
+    The file can be shared by several PyCmd instances: all accesses are
+    serialized by a lock file, and each instance remembers how far it has
+    read the journal, so that it only needs to replay the records appended
+    by the others since then (see update()).
+    """
+    def __init__(self, filename, length):
+        self.filename = filename
+
+        # Maximum number of lines to keep
+        self.length = length
+
+        # Number of records in the journal (None if not read yet)
+        self.records = None
+
+        # The lines in the journal, as replayed so far
+        self.lines = OrderedDict()
+
+        # Offset (bytes) of the first record not replayed yet, and the
+        # generation of the file it refers to (see FileLock)
+        self.offset = 0
+        self.generation = None
+
+        # Records appended by other instances, not yet returned by update();
+        # None if the journal was rewritten and must be reloaded completely
+        self.incoming = []
+
+        # Serializes the threads using this instance (main, history writer)
+        self.mutex = threading.Lock()
+        self.file_lock = FileLock(filename + '.lock')
+
+    def read(self):
+        """Replay the journal and return the list of lines (oldest first)"""
+        with self.mutex:
+            with self.file_lock:
+                self._replay()
+            self.incoming = []
+            return self._tail()
+
+    def update(self):
+        """
+        Replay the records that other instances have appended since the
+        last call and return them (in order); return None if the journal
+        was rewritten in the meantime -- read() returns the new history
+        """
+        with self.mutex:
+            with self.file_lock:
+                self._replay()
+            incoming = self.incoming
+            self.incoming = []
+            return incoming
+
+    def exists(self):
+        """Tell whether there is a history to read"""
+        return os.path.isfile(self.filename)
+
+    def add(self, line, info=None):
+        """
+        Add a line (moves it to the end if already present); the command
+        information (see HistoryDatabase) is not stored in the file
+        """
+        self.append([line])
+
+    def remove(self, line):
+        """Remove a line"""
+        self.append([REMOVE_MARKER + line])
+
+    def append(self, records, fsync=False, info=None):
+        """
+        Append records to the journal (optionally syncing them to the disk),
+        compact it if it grew too long
+        """
+        with self.mutex:
+            with self.file_lock:
+                # Catch up with the other instances first, so that our own
+                # records don't need to be replayed later
+                self._replay()
+                history_file = open(self.filename, 'ab')
+                history_file.write(u''.join([r + u'\n' for r in records]).encode('utf8', 'replace'))
+                if fsync:
+                    history_file.flush()
+                    os.fsync(history_file.fileno())
+                self.offset = history_file.tell()
+                history_file.close()
+                for record in records:
+                    self._apply(record)
+                if self.incoming:
+                    # Keep the order of the file when the others' records
+                    # are merged
+                    self.incoming.extend(records)
+                self.records += len(records)
+                if self.length is not None and self.records > 2 * self.length:
+                    self._compact()
+
+    def compact(self):
+        """Rewrite the journal as the plain list of lines"""
+        with self.mutex:
+            with self.file_lock:
+                self._replay()
+                self._compact()
+
+    def _replay(self):
+        """Replay the new records in the journal (the file lock is held)"""
+        generation = self.file_lock.generation()
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if self.records is None or generation != self.generation or size < self.offset:
+            # First read, or rewritten by another instance: start over
+            if self.records is not None:
+                self.incoming = None
+            self.lines = OrderedDict()
+            self.records = 0
+            self.offset = 0
+            self.generation = generation
+        if size == self.offset:
+            return
+
+        history_file = open(self.filename, 'rb')
+        history_file.seek(self.offset)
+        data = history_file.read()
+        history_file.close()
+
+        # Only replay complete records
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        for record in data[:end].decode('utf8', 'replace').split(u'\n')[:-1]:
+            record = record.rstrip(u'\r')
+            self.records += 1
+            self._apply(record)
+            if self.incoming is not None:
+                self.incoming.append(record)
+                if self.length is not None and len(self.incoming) > self.length:
+                    # Nobody is picking them up, reloading will be cheaper
+                    self.incoming = None
+
+    def _apply(self, record):
+        """Replay a record"""
+        if record.startswith(REMOVE_MARKER):
+            self.lines.pop(record[len(REMOVE_MARKER):], None)
+        else:
+            self.lines.pop(record, None)
+            self.lines[record] = None
+
+    def _tail(self):
+        """Return the lines to keep"""
+        lines = list(self.lines)
+        if self.length is not None and len(lines) > self.length:
+            lines = lines[-self.length :]
+        return lines
+
+    def _compact(self):
+        """Rewrite the journal as the plain list of lines (the file lock is held)"""
+        lines = self._tail()
+        temp_filename = self.filename + '.tmp'
+        history_file = open(temp_filename, 'wb')
+        history_file.write(u''.join([l + u'\n' for l in lines]).encode('utf8', 'replace'))
+        history_file.close()
+        os.replace(temp_filename, self.filename)
+        self.lines = OrderedDict((l, None) for l in lines)
+        self.records = len(lines)
+        self.offset = os.path.getsize(self.filename)
+        self.generation = self.file_lock.rewritten()
+
+
+def coalesce(records):
+    """
+    Drop the records made redundant by a later record for the same line;
+    replaying the result gives the same history
+    """
+    last = OrderedDict()
+    for record in records:
+        line = record[len(REMOVE_MARKER):] if record.startswith(REMOVE_MARKER) else record
+        last.pop(line, None)
+        last[line] = record
+    return list(last.values())
+
+
+class HistoryWriter(threading.Thread):
+    """
+    Background thread that appends the history records to their files, so
+    that the disk I/O doesn't delay the prompt. Records are collected for a
+    short while and written in batches, one append per file.
+    """
+    def __init__(self, delay=0.5, fsync=False, max_pending=1000):
+        threading.Thread.__init__(self, name='HistoryWriter')
+        self.daemon = True
+
+        # Time (seconds) to wait for more records before writing a batch
+        self.delay = delay
+
+        # Sync the written records to the disk (slower, but survives crashes
+        # of the OS as well)
+        self.fsync = fsync
+
+        # Pending records (history_file, record, info); None stops the writer,
+        # an Event requests a flush
+        self.queue = Queue(max_pending)
+
+        # The last error encountered while writing (if any)
+        self.error = None
+
+    def add(self, history_file, line, info=None):
+        """Queue a line (and its command information) to be added to a history file"""
+        self.queue.put((history_file, line, info))
+
+    def remove(self, history_file, line):
+        """Queue a line to be removed from a history file"""
+        self.queue.put((history_file, REMOVE_MARKER + line, None))
+
+    def flush(self, timeout=None):
+        """Wait until the records queued so far are written"""
+        if self.is_alive():
+            written = threading.Event()
+            self.queue.put(written)
+            written.wait(timeout)
+
+    def close(self, timeout=None):
+        """Write the pending records and stop the writer"""
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.delay
+            while isinstance(batch[-1], tuple):
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+                except Empty:
+                    break
+
+            # Write the records, grouped by file
+            records = OrderedDict()
+            infos = {}
+            for item in batch:
+                if isinstance(item, tuple):
+                    (history_file, record, info) = item
+                    records.setdefault(history_file, []).append(record)
+                    if info:
+                        infos.setdefault(history_file, {})[record] = info
+            for history_file, file_records in records.items():
+                try:
+                    history_file.append(coalesce(file_records), self.fsync,
+                                        infos.get(history_file))
+                except Exception as error:
+                    # Only these records are lost, keep writing the next ones
+                    self.error = error
+
+            if batch[-1] is None:
+                running = False
+            elif isinstance(batch[-1], threading.Event):
+                batch[-1].set()
@@ -1,6 +1,6 @@
 from CommandHistory import CommandHistory
-from common import word_sep, tokenize, seq_tokens
-from completion import complete_file, complete_env_var, has_wildcards
+from common import word_sep, seq_tokens, LineTokenizer
+from completion import complete_env_var, has_wildcards, Completer
 import win32clipboard as wclip
 
 EXTEND_SEPARATORS_OUTSIDE_QUOTES = \
@@ -52,6 +52,10 @@ class InputState:
         * the command history
         * dynamic expansion based on the input history
     """
+    # Pause in the typing (seconds) before completing a file name for the
+    # suggestion, and the time allowed for the completion
+    suggestion_delay = 0.1
+    suggestion_timeout = 1
 
     def __init__(self):
         # Current state of the input line
@@ -69,6 +73,15 @@ class InputState:
         # Some error needs to be notified with a bell
         self.bell = False
 
+        # Tokenizes the text before cursor as it is edited
+        self.tokenizer = LineTokenizer()
+
+        # The file completion for the suggestion is computed in the background,
+        # see update_suggestion() and apply_suggestion()
+        self.completer = Completer()
+        self.suggestion_request = None
+        self.suggestion_line = None
+
         # Typing overwrite mode
         self.overwrite = False
 
@@ -231,21 +244,52 @@ class InputState:
 
     def update_suggestion(self):
         suggestions = []
+        self.completer.cancel()
+        self.suggestion_request = None
         if self.before_cursor + self.after_cursor:
-            suggestions = [l for l in reversed(self.history.list) if l.startswith(self.before_cursor + self.after_cursor)]
+            latest = self.history.latest(self.before_cursor + self.after_cursor)
+            suggestions = [latest] if latest is not None else []
             if not suggestions:
-                tokens = tokenize(self.before_cursor)
+                tokens = self.tokenizer.tokenize(self.before_cursor)
                 if len(tokens) > 1 and not tokens[-2] in seq_tokens and not has_wildcards(tokens[-1]):
                     if tokens[-1].count('%') % 2 == 1:
                         completed, completions = complete_env_var(self.before_cursor)
+                        if self.suggestable(completed, completions):
+                            suggestions = [completed]
                     else:
-                        completed, completions = complete_file(self.before_cursor, timeout=0.1)
-                    if completed.lower().startswith(self.before_cursor.lower()) and len(completions) == 1:
-                        suggestions = [completed]
+                        # Listing directories can take a while, this is left to
+                        # the completer (once the typing pauses)
+                        self.suggestion_request = self.completer.request(self.before_cursor,
+                                                                         self.suggestion_timeout,
+                                                                         self.suggestion_delay)
+                        self.suggestion_line = self.before_cursor + self.after_cursor
         suggestion = suggestions[0][len(self.before_cursor + self.after_cursor):] if suggestions else ''
         self.prev_suggestion = self.suggestion
         self.suggestion = suggestion
 
+    def apply_suggestion(self):
+        """
+        Show the suggestion computed in the background, if the line hasn't
+        changed meanwhile; return False if the suggestion is still pending
+        """
+        request = self.suggestion_request
+        if request is None:
+            return True
+        if not request.wait(0):
+            return False
+        self.suggestion_request = None
+        line = self.before_cursor + self.after_cursor
+        if request.valid(self.before_cursor) and line == self.suggestion_line:
+            completed, completions = request.get()
+            if self.suggestable(completed, completions):
+                self.suggestion = completed[len(line):]
+        return True
+
+    def suggestable(self, completed, completions):
+        """Tell whether a completion of the text before cursor makes a suggestion"""
+        return (completed.lower().startswith(self.before_cursor.lower()) and len(completions) == 1
+                and not getattr(completions, 'incomplete', False))
+
 
     def key_left(self, select=False):
         """
@@ -1,20 +1,23 @@
 
 from __future__ import print_function
 
-import sys, os, tempfile, signal, time, traceback, codecs, platform
+import sys, os, tempfile, signal, time, traceback, platform, atexit
 import win32console, win32gui, win32con, win32api
 
 from common import tokenize, unescape, escape_special_chars_in_quotes, sep_tokens, sep_chars, exec_extensions, pseudo_vars
 from common import expand_tilde, expand_env_vars
 from common import associated_application, full_executable_path, is_gui_application
-from completion import complete_file, complete_wildcard, complete_env_var, find_common_prefix, has_wildcards, wildcard_to_regex
+from common import executable_index
+from completion import completer, find_common_prefix, has_wildcards, wildcard_to_regex
 from InputState import ActionCode, InputState
 from DirHistory import DirHistory
+from HistoryFile import HistoryFile, HistoryWriter, REMOVE_MARKER
+from HistoryDatabase import HistoryDatabase
 import console
 import re
 from sys import stdout, stderr
 from console import move_cursor, get_cursor, cursor_backward, erase_to, set_cursor_attributes
-from console import read_input, write_input
+from console import read_input, write_input, input_pending
 from console import is_ctrl_pressed, is_alt_pressed, is_shift_pressed, is_control_only
 from console import scroll_buffer, get_viewport, scroll_to_quarter, get_buffer_size
 from console import remove_escape_sequences
@@ -35,6 +38,8 @@ dir_hist = None
 dir_favorites = None
 pushd_stack = []
 tmpfile = None
+history_files = {}
+history_writer = None
 
 def init():
     # %APPDATA% is not always defined (e.g. when using runas.exe)
@@ -60,17 +65,29 @@ def init():
     apply_settings(pycmd_data_dir + '\\init.py')
     sanitize_settings()
 
+    # Keep the index of the executables in the PATH across sessions
+    executable_index.filename = pycmd_data_dir + '\\executables.json'
+    atexit.register(executable_index.flush, 5)
+
+    # Save the histories in the background
+    global history_writer
+    history_writer = HistoryWriter(behavior.history_flush_delay, behavior.history_fsync)
+    history_writer.start()
+    atexit.register(history_writer.close)
+
     # Current state of the input (prompt, entered chars, history)
     global state
     state = InputState()
 
     # Read/initialize command history
-    state.history.list = read_history(pycmd_data_dir + '\\history')
+    state.history.list = read_history(pycmd_data_dir + '\\history',
+                                      behavior.max_cmd_history_length)
 
     # Read/initialize directory history
     global dir_hist
     dir_hist = DirHistory()
-    dir_hist.locations = read_history(pycmd_data_dir + '\\dir_history')
+    dir_hist.locations = read_history(pycmd_data_dir + '\\dir_history',
+                                      behavior.max_dir_history_length)
     dir_hist.index = len(dir_hist.locations) - 1
     dir_hist.visit_cwd()
 
@@ -92,6 +109,8 @@ def init():
     signal.signal(signal.SIGINT, signal_handler)
 
 def deinit():
+    if history_writer:
+        history_writer.close()
     os.remove(tmpfile)
 
 def main():
@@ -162,6 +181,10 @@ def main():
 
     # Main loop
     while True:
+        # Pick up the commands run in the other PyCmd instances
+        if behavior.history_share:
+            merge_history()
+
         # Prepare buffer for reading one line
         state.reset_line(appearance.prompt())
         scrolling = False
@@ -231,6 +254,14 @@ def main():
             # Prepare new input state
             state.step_line()
 
+            # Show the suggestion computed in the background once ready,
+            # unless a key is pressed first
+            if state.suggestion_request is not None:
+                while not (state.suggestion_request.wait(0.02) or input_pending()):
+                    pass
+                if state.apply_suggestion():
+                    continue
+
             # Read and process a keyboard event
             rec = read_input()
             select = auto_select or is_shift_pressed(rec)
@@ -469,14 +500,20 @@ def main():
                         state.handle(ActionCode.ACTION_ESCAPE)
                         auto_select = False
                 elif rec.Char == '\t':                  # Tab
+                    tokens = state.tokenizer.tokenize(state.before_cursor)
+                    request = completer.request(state.before_cursor, behavior.completion_timeout)
+                    while not request.wait(0.05):
+                        if input_pending():
+                            # Typing on, the completion is stale
+                            request.cancel()
+                            break
+                    if not request.valid(state.before_cursor):
+                        continue
                     set_cursor_attributes(cursor_height, False)
-                    tokens = tokenize(state.before_cursor)
-                    if tokens[-1].strip('"').count('%') % 2 == 1:
-                        (completed, suggestions) = complete_env_var(state.before_cursor)
-                    elif has_wildcards(tokens[-1]):
-                        (completed, suggestions)  = complete_wildcard(state.before_cursor)
-                    else:
-                        (completed, suggestions)  = complete_file(state.before_cursor)
+                    (completed, suggestions) = request.get()
+                    if suggestions.incomplete:
+                        # Some directories took too long to list, notify
+                        state.bell = True
 
                     stdout.write(state.after_cursor + ' ' * len(state.suggestion))
                     cursor_backward(len(state.suggestion) + len(state.after_cursor) + len(state.before_cursor))
@@ -491,16 +528,17 @@ def main():
                     if not suggestions:
                         # No completion possible, require notification
                         state.bell = True
-                    elif len(suggestions) > 1:
-                        # Multiple completions possible
+                    elif len(suggestions) > 1 or suggestions.incomplete:
+                        # Multiple completions possible (or some are missing)
                         path_sep = '/' if '/' in expand_env_vars(tokens[-1]) else '\\'
                         if tokens[-1]:
                             # Tokenize again in case the original line has been appended to
                             tokens = tokenize(completed.rstrip(' ').rstrip(path_sep))
                         token = tokens[-1].replace('"', '')
 
-                        if has_wildcards(tokens[-1]):
-                            # Substring matching wildcards will be printed in a different color
+                        if has_wildcards(tokens[-1]) or suggestions.incomplete:
+                            # Substring matching wildcards (or the typed prefix, as the
+                            # line was not completed) will be printed in a different color
                             (_, _, prefix) = token.rpartition(path_sep)
                         else:
                             # Length of the common prefix will be printed in a different color
@@ -540,11 +578,12 @@ def main():
                                 cursor_backward(len(state.after_cursor) + len(state.suggestion))
                                 action, selection = w.interact()
                                 if action == 'select' and selection:
-                                    orig_last_token = tokenize(state.before_cursor)[-1]
+                                    last_token = state.tokenizer.tokenize_spans(state.before_cursor)[-1]
+                                    orig_last_token = last_token.text
 
                                     # Replace initial completion prefix with selection,
                                     # add quotes and slashes as needed
-                                    pos = state.before_cursor.lower().rfind(prefix.lower())
+                                    pos = state.before_cursor.lower().rfind(prefix.lower(), last_token.start)
                                     state.before_cursor = (state.before_cursor[:pos]
                                                            + selection
                                                            + state.before_cursor[pos + len(prefix):])
@@ -555,7 +594,7 @@ def main():
                                     if orig_last_token.startswith('"'):
                                         state.before_cursor += '"'
                                     elif ' ' in selection:
-                                        pos = state.before_cursor.rfind(orig_last_token)
+                                        pos = last_token.start
                                         state.before_cursor = state.before_cursor[:pos] + '"' + state.before_cursor[pos:] + '"'
                                     if (not selection.endswith(path_sep)
                                         and not orig_last_token.count('%') % 2 == 1
@@ -571,9 +610,7 @@ def main():
                 elif rec.Char == chr(8):                # Backspace
                     state.handle(ActionCode.ACTION_BACKSPACE)
                 else:                                   # Regular character
-                    tokens_before = tokenize(state.before_cursor)
                     state.handle(ActionCode.ACTION_INSERT, rec.Char)
-                    tokens_after = tokenize(state.before_cursor)
 
         # Done reading line, now execute
         stdout.write(state.after_cursor)        # Move cursor to the end
@@ -588,13 +625,18 @@ def main():
             print()
             if not is_pure_cd(tokens):
                 dir_hist.keep = True
+            command_info = {'timestamp': time.time(), 'cwd': os.getcwd()}
             run_command(tokens)
+            command_info['duration'] = time.time() - command_info['timestamp']
+            errorlevel = os.environ.get('ERRORLEVEL', '')
+            command_info['exit_code'] = int(errorlevel) if errorlevel.lstrip('-').isdigit() else None
 
         # Add to history
         state.history.add(line)
         update_history('add', state.history.list[-1],
                        pycmd_data_dir + '\\history',
-                       behavior.max_cmd_history_length)
+                       behavior.max_cmd_history_length,
+                       command_info)
 
         # Add to dir history
         dir_hist.visit_cwd()
@@ -836,43 +878,77 @@ def optimal_window_height():
     return window_height
 
 
-def update_history(action, line, filename, length):
+def history_file(filename, length=None):
+    """
+    Return the (shared) journal of a history file; the length, if specified,
+    updates the number of lines to keep
+    """
+    if not filename in history_files:
+        if behavior.history_backend == 'sqlite':
+            history_files[filename] = HistoryDatabase(filename, length, behavior.history_fsync)
+        else:
+            history_files[filename] = HistoryFile(filename, length)
+    if length is not None:
+        history_files[filename].length = length
+    return history_files[filename]
+
+
+def update_history(action, line, filename, length, info=None):
     """
     Append/remove a line to/from a history file.  
     When adding, if the line was already present in the file, we move it to
-    the end. The resulting file is then truncated to the specified number of 
-    lines.
+    the end. The file is a journal of add/remove records, this only appends
+    a record (in the background, if the history writer is running); the
+    journal is compacted (and truncated to the specified number of lines)
+    once it grows too long. With the SQLite backend, the command information
+    (timestamp, cwd, exit_code and duration) is saved as well.
     """
-    if os.path.isfile(filename):
-        # Read previously saved history and merge with current
-        history_file = codecs.open(filename, 'r', 'utf8', 'replace')
-        history_to_save = [l.rstrip(u'\n') for l in history_file.readlines()]
-        history_file.close()
-        if line in history_to_save:
-            history_to_save.remove(line)
+    journal = history_file(filename, length)
+    if history_writer and history_writer.is_alive():
+        # Let the background writer do the I/O
         if action == 'add':
-            history_to_save.append(line)
+            history_writer.add(journal, line, info)
+        else:
+            history_writer.remove(journal, line)
     else:
-        # No previous history, save current (only if adding)
-        history_to_save = [line] if action == 'add' else []
+        # No writer (or it stopped), write the record right away
+        if action == 'add':
+            journal.add(line, info)
+        else:
+            journal.remove(line)
 
-    if len(history_to_save) > length:
-        history_to_save = history_to_save[-length :]    # Limit history file
 
-    # Write merged history to history file
-    history_file = codecs.open(filename, 'w', 'utf8')
-    history_file.writelines([l + u'\n' for l in history_to_save])
-    history_file.close()
+def merge_history():
+    """
+    Merge the records appended to the command history file by the other
+    PyCmd instances into the current history
+    """
+    journal = history_file(pycmd_data_dir + '\\history')
+    try:
+        records = journal.update()
+    except (IOError, OSError):
+        return
+    if records is None:
+        # The file was rewritten, reload it (after saving our own records)
+        if history_writer:
+            history_writer.flush()
+        state.history.list = journal.read()
+        return
+    for record in records:
+        if record.startswith(REMOVE_MARKER):
+            state.history.zap(record[len(REMOVE_MARKER):])
+        else:
+            state.history.add(record)
 
 
-def read_history(filename):
+def read_history(filename, length=None):
     """
-    Read and return a list of lines from a history file
+    Read and return a list of lines from a history file (at most length
+    lines, if specified)
     """
-    if os.path.isfile(filename):
-        history_file = codecs.open(filename, 'r', 'utf8', 'replace')
-        history = [line.rstrip(u'\n\r') for line in history_file.readlines()]
-        history_file.close()
+    journal = history_file(filename, length)
+    if journal.exists():
+        history = journal.read()
     else:
         print('Warning: Can\'t open ' + os.path.basename(filename) + '!')
         history = []
@@ -922,6 +998,9 @@ if __name__ == '__main__':
         report_file = open(report_file_name, 'w')
         traceback.print_exc(file=report_file)
         report_file.close()
+        if history_writer:
+            # Don't lose the history entries that are still queued
+            history_writer.close(timeout=5)
         traceback.print_exc()
         print()
         print('Crash report written to:\n  ' + report_file_name)
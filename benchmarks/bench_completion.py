@@ -0,0 +1,83 @@
+#
+# Benchmark for the completion of command names from the PATH
+#
+# Creates a PATH of synthetic executables (10k by default) and times the
+# completion of short prefixes, which match most of them. Run from the
+# PyCmd directory:
+#
+#     python benchmarks\bench_completion.py [number of executables]
+#
+
+from __future__ import print_function
+
+import os, sys, time, tempfile, shutil, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from completion import complete_file, strip_exec_extensions, find_common_prefix
+from common import executable_index
+
+def create_executables(count, rand):
+    """Create count executables spread over a few PATH directories"""
+    root = tempfile.mkdtemp()
+    dirs = [os.path.join(root, 'bin%d' % i) for i in range(10)]
+    for d in dirs:
+        os.mkdir(d)
+    for i in range(count):
+        # Some names come with several extensions, which must be kept
+        name = 'a' + ''.join(rand.choice('abcdefgh') for j in range(6))
+        for ext in rand.sample(['.exe', '.bat', '.cmd', '.com'], rand.choice([1, 1, 1, 2])):
+            open(os.path.join(rand.choice(dirs), name + ext), 'w').close()
+
+    # Pretend the directories were last modified a while ago (the listings of
+    # recently modified directories are not kept)
+    past = time.time() - 60
+    for d in dirs:
+        os.utime(d, (past, past))
+    return (root, dirs)
+
+
+def timed(function, *args):
+    """Return the best time (seconds) of a few runs"""
+    best = None
+    for i in range(5):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rand = random.Random(0)
+    (root, dirs) = create_executables(count, rand)
+    orig_path = os.environ['PATH']
+    orig_cwd = os.getcwd()
+    try:
+        os.environ['PATH'] = os.pathsep.join(dirs)
+        os.chdir(root)
+
+        start = time.time()
+        (_, completions) = complete_file('a')
+        print('First completion (index built): %8.3f s, %d completions'
+              % (time.time() - start, len(completions)))
+        for prefix in ['a', 'ab', 'abc']:
+            print('Completing %-5s %25.3f s' % ('"' + prefix + '"', timed(complete_file, prefix)))
+
+        names = sorted(set(name for (_, names) in executable_index.executables()[0] for name in names),
+                       key=str.lower)
+        print('Stripping the extensions of %d names: %6.3f s'
+              % (len(names), timed(strip_exec_extensions, names, [], 'a')))
+        print('Common prefix of %d names: %17.3f s'
+              % (len(names), timed(find_common_prefix, 'A', names)))
+        long_names = ['Quarterly_Report_2024_Final_' + name for name in names]
+        print('Common prefix of %d long names: %12.3f s'
+              % (len(long_names), timed(find_common_prefix, 'quarterly_report_2024_fin', long_names)))
+    finally:
+        os.environ['PATH'] = orig_path
+        os.chdir(orig_cwd)
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#
+# Benchmark for the tokenization of the command line
+#
+# The line is tokenized after every keystroke; this times tokenizing each
+# prefix of a few typical lines (and of a long, pasted compiler command)
+# incrementally (LineTokenizer), with the compiled scanner, with the shared
+# parser FSM (frozen or not) and rebuilding the FSM for every call (as
+# parse_line used to).
+# Run from the PyCmd directory:
+#
+#     python benchmarks\bench_tokenize.py
+#
+
+from __future__ import print_function
+
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common
+from common import tokenize, line_parser, parse_line_fsm, LineTokenizer
+
+lines = ['dir /s /b *.py | findstr /i test > "C:\\Temp\\tests.txt" 2>&1',
+         'git commit -a -m "Fix the completion of quoted paths" && git push',
+         'cl.exe ' + ' '.join('/I"C:\\Program Files\\SDK\\include\\%d" /DFEATURE_%d=1' % (i, i)
+                              for i in range(40)) + ' main.c /Fe:main.exe']
+
+def timed(function, *args):
+    """Return the best time (seconds) of a few runs"""
+    best = None
+    for i in range(5):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def type_line(line):
+    """Tokenize the line after each keystroke"""
+    for i in range(1, len(line) + 1):
+        tokenize(line[:i])
+
+
+def type_line_incrementally(line):
+    """Tokenize the line after each keystroke, with a LineTokenizer"""
+    tokenizer = LineTokenizer()
+    for i in range(1, len(line) + 1):
+        tokenizer.tokenize(line[:i])
+
+
+class RebuiltFSM(object):
+    """Stands for common.line_fsm, but builds a new machine for every parse"""
+    def copy(self, memory):
+        f = line_parser()
+        f.memory = memory
+        return f
+
+
+class FSMScanner(object):
+    """Stands for common.line_scanner, but runs the parser FSM"""
+    def scan(self, line):
+        return parse_line_fsm(line)
+
+
+def main():
+    scanner = common.line_scanner
+    frozen_fsm = common.line_fsm
+    shared_fsm = line_parser()
+    for line in lines:
+        common.line_scanner = FSMScanner()
+        common.line_fsm = RebuiltFSM()
+        rebuilt = timed(type_line, line)
+        common.line_fsm = shared_fsm
+        shared = timed(type_line, line)
+        common.line_fsm = frozen_fsm
+        frozen = timed(type_line, line)
+        common.line_scanner = scanner
+        compiled = timed(type_line, line)
+        incremental = timed(type_line_incrementally, line)
+        print('%4d chars, us/keystroke: %7.1f rebuilding the FSM, %7.1f shared FSM, '
+              '%7.1f frozen FSM, %7.1f compiled, %7.1f incremental'
+              % (len(line), rebuilt / len(line) * 1e6, shared / len(line) * 1e6,
+                 frozen / len(line) * 1e6, compiled / len(line) * 1e6,
+                 incremental / len(line) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
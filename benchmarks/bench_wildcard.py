@@ -0,0 +1,65 @@
+#
+# Benchmark for the wildcard matchers used by the completion
+#
+# Times building the matchers (cached or not) and filtering a list of
+# synthetic file names (10k by default) with them; plain prefixes are also
+# matched with a casefolded startswith, for comparison. Run from the PyCmd
+# directory:
+#
+#     python benchmarks\bench_wildcard.py [number of names]
+#
+
+from __future__ import print_function
+
+import os, sys, time, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from completion import wildcard_to_regex
+
+def timed(function, *args):
+    """Return the best time (seconds) of a few runs"""
+    best = None
+    for i in range(5):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def build(patterns, function):
+    for pattern in patterns:
+        function(pattern)
+
+
+def match(matcher, names):
+    return [name for name in names if matcher.match(name)]
+
+
+def match_prefix(prefix, names):
+    prefix = prefix.casefold()
+    return [name for name in names if name.casefold().startswith(prefix)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rand = random.Random(0)
+    names = [''.join(rand.choice('abcdefgh') for j in range(rand.randint(3, 12)))
+             + rand.choice(['.exe', '.txt', '.py', '']) for i in range(count)]
+
+    # Patterns as built while typing, one per keystroke
+    patterns = ['ab*', 'abc*', 'a*.txt', 'ab?d*'] * 250
+    uncached = wildcard_to_regex.__wrapped__
+    print('Building %d matchers, uncached: %14.3f s' % (len(patterns), timed(build, patterns, uncached)))
+    print('Building %d matchers, cached: %16.3f s' % (len(patterns), timed(build, patterns, wildcard_to_regex)))
+
+    for prefix in ['a', 'ab', 'ABC']:
+        print('Matching %-8s regex: %8.3f s, casefolded startswith: %8.3f s'
+              % ('"' + prefix + '*"', timed(match, wildcard_to_regex(prefix + '*'), names),
+                 timed(match_prefix, prefix, names)))
+    for pattern in ['a*.txt', 'ab?d*']:
+        print('Matching %-8s regex: %8.3f s' % ('"' + pattern + '"', timed(match, wildcard_to_regex(pattern), names)))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,17 +4,20 @@
 
 from __future__ import print_function
 
-import os, string, fsm, pefile, mmap, sys, traceback
+import os, string, fsm, pefile, mmap, sys, traceback, time, json, threading, bisect
 from console import get_cursor, move_cursor, get_viewport
 import re
 import pycmd_public
+from collections import namedtuple
 
 py2 = sys.version_info[0] == 2
 
 if py2:
     import _winreg as winreg
+    from Queue import Queue
 else:
     import winreg
+    from queue import Queue
 
 _debug_messages = []
 def debug(message):
@@ -60,9 +63,11 @@ exec_extensions = os.environ['PATHEXT'].lower().split(os.pathsep)
 # Pseudo environment variables
 pseudo_vars = ['CD', 'DATE', 'ERRORLEVEL', 'RANDOM', 'TIME']
 
-def parse_line(line):
-    """Tokenize a command line based on whitespace while observing quotes"""
-
+def line_parser():
+    """
+    Build the FSM used by parse_line(); its memory is the list of tokens,
+    the last one being the token in progress
+    """
     def accumulate(fsm):
         """Action: add current symbol to last token in list."""
         fsm.memory[-1] = fsm.memory[-1] + fsm.input_symbol
@@ -87,7 +92,7 @@ def parse_line(line):
         print('Unhandled transition:', (fsm.input_symbol, fsm.current_state))
         accumulate(fsm)
 
-    f = fsm.FSM('init', [''])
+    f = fsm.FSM('init')
 
     f.set_default_transition(error, 'init')
 
@@ -139,6 +144,20 @@ def parse_line(line):
     # seen '^'
     f.add_transition_any('escape', accumulate, 'init')
 
+    return f
+
+# The transitions are built (and resolved) once, parse_line_fsm() runs
+# copies of this machine
+line_fsm = line_parser()
+line_fsm.freeze()
+
+
+def parse_line_fsm(line):
+    """
+    Tokenize a command line by running the parser FSM one character at a
+    time (reference implementation of parse_line)
+    """
+    f = line_fsm.copy([''])
     f.process_list(line)
     if len(f.memory) > 0 and f.memory[-1] == '':
         del f.memory[-1]
@@ -146,16 +165,249 @@ def parse_line(line):
     return f.memory
 
 
+class LineScanner(object):
+    """
+    The parser FSM compiled into tables: the characters are grouped into
+    classes that the FSM handles alike, and for each state and class the
+    table gives the resolved effect on the tokens (empty transitions
+    included) and the next state. The tokens are contiguous parts of the
+    line, so they are sliced out of it rather than accumulated.
+    """
+    # Effects of the transitions on the tokens, as found by running them on
+    # the token 'x' with the input symbol 'c':
+    #   (start a new token, accumulate the symbol, then start a new token)
+    effects = {('x',): (False, False, False),
+               ('x', ''): (True, False, False),
+               ('xc',): (False, True, False),
+               ('x', 'c'): (True, True, False),
+               ('xc', ''): (False, True, True),
+               ('x', 'c', ''): (True, True, True)}
+
+    def __init__(self, f):
+        states = set([f.initial_state])
+        states.update(state for (_, state) in f.state_transitions)
+        states.update(f.state_transitions_any)
+        states.update(f.state_empty_transitions)
+        for table in [f.state_transitions, f.state_transitions_any, f.state_empty_transitions]:
+            states.update(next_state for (_, next_state) in table.values())
+        if f.default_transition is not None:
+            states.add(f.default_transition[1])
+        self.states = sorted(states)
+        self.initial_state = self.states.index(f.initial_state)
+
+        # Group the symbols with the same transitions into classes; the other
+        # characters make class 0
+        symbols = sorted(set(symbol for (symbol, _) in f.state_transitions))
+        columns = {}
+        for symbol in [None] + symbols:
+            column = tuple(self.resolve(f, state, symbol) for state in self.states)
+            columns.setdefault(column, []).append(symbol)
+        classes = sorted(columns.items(), key=lambda item: item[1][0] is not None)
+        self.classes = {}
+        for (index, (_, members)) in enumerate(classes):
+            for symbol in members:
+                if symbol is not None:
+                    self.classes[symbol] = index
+
+        # Table: state --> class --> (new token, accumulate, new token, next state)
+        self.table = [[column[state] for (column, _) in classes]
+                      for state in range(len(self.states))]
+
+        # Runs of characters that only accumulate in a state are skipped at once
+        self.runs = []
+        for state in range(len(self.states)):
+            if self.table[state][0] == (False, True, False, state):
+                others = [symbol for (symbol, index) in self.classes.items()
+                          if self.table[state][index] != (False, True, False, state)]
+                self.runs.append(re.compile('[^' + re.escape(''.join(sorted(others))) + ']+'))
+            else:
+                self.runs.append(None)
+
+    def resolve(self, f, state, symbol):
+        """Run a transition of f, return its effect on the tokens and the next state"""
+        probe = f.copy(['x'])
+        probe.current_state = state
+        probe.process('c' if symbol is None else symbol)
+        memory = tuple(token.replace(symbol, 'c') if symbol is not None else token
+                       for token in probe.memory)
+        if not memory in self.effects:
+            raise ValueError('Transition (%s, %s) can\'t be compiled' % (symbol, state))
+        return self.effects[memory] + (self.states.index(probe.current_state),)
+
+    def scan(self, line, pos=0, state=None, tokens=None, checkpoints=None, spans=None):
+        """
+        Return the tokens of the line, see parse_line(). The scan can start
+        at a token boundary: pos, the state there and the tokens before it
+        (as recorded in checkpoints). If given, checkpoints is a list of
+        (pos, state, number of tokens) where the boundaries met are added,
+        and spans a list where the (start, end) of the tokens are added.
+        """
+        tokens = [] if tokens is None else tokens
+        classes = self.classes
+        table = self.table
+        runs = self.runs
+        state = self.initial_state if state is None else state
+        start = pos
+        end = len(line)
+        while pos < end:
+            run = runs[state]
+            if run is not None:
+                match = run.match(line, pos)
+                if match:
+                    pos = match.end()
+                    continue
+            (new_token, accumulate, new_token_after, state) = table[state][classes.get(line[pos], 0)]
+            if new_token and start < pos:
+                tokens.append(line[start:pos])
+                if spans is not None:
+                    spans.append((start, pos))
+                start = pos
+            if not accumulate:
+                # Skipped, the current token is empty
+                start = pos + 1
+            elif new_token_after:
+                tokens.append(line[start:pos + 1])
+                if spans is not None:
+                    spans.append((start, pos + 1))
+                start = pos + 1
+            pos += 1
+            if start == pos and checkpoints is not None:
+                checkpoints.append((pos, state, len(tokens)))
+        if start < end:
+            tokens.append(line[start:])
+            if spans is not None:
+                spans.append((start, end))
+        return tokens
+
+
+line_scanner = LineScanner(line_fsm)
+
+
+def parse_line(line):
+    """Tokenize a command line based on whitespace while observing quotes"""
+    return line_scanner.scan(line)
+
+
 def tokenize(line):
     """
     Wrapper for parse_line that appends an empty token if it detects a new token is beginning
     """
     tokens = parse_line(line)
-    if tokens == [] or (line[-1] in sep_chars and parse_line(line) == parse_line(line + ' ')):
+    if tokens == [] or (line[-1] in sep_chars and tokens == parse_line(line + ' ')):
         tokens += ['']   # This saves us some checks later
     return tokens
 
 
+# Kinds of tokens
+TOKEN_WORD = 'word'
+TOKEN_SEQ = 'seq'           # Sequence operator (|, ||, &, &&)
+TOKEN_REDIR = 'redir'       # Redirection (>, 2>>, <&3 etc.)
+
+# A token and its position in the line (line[start:end] == text)
+Token = namedtuple('Token', ['text', 'start', 'end', 'kind'])
+
+
+def token_kind(text):
+    """Return the kind of a token: TOKEN_WORD, TOKEN_SEQ or TOKEN_REDIR"""
+    if text in seq_tokens:
+        return TOKEN_SEQ
+    elif text in redir_file_tokens:
+        return TOKEN_REDIR
+    else:
+        return TOKEN_WORD
+
+
+def make_tokens(tokens, spans):
+    """Build the Token records from the tokens and their (start, end)"""
+    return [Token(text, start, end, token_kind(text))
+            for (text, (start, end)) in zip(tokens, spans)]
+
+
+def parse_line_spans(line):
+    """parse_line() returning Token records, with the position of each token"""
+    spans = []
+    tokens = line_scanner.scan(line, spans=spans)
+    return make_tokens(tokens, spans)
+
+
+def tokenize_spans(line):
+    """
+    tokenize() returning Token records; the empty token appended for a new
+    token lies at the end of the line
+    """
+    tokens = parse_line_spans(line)
+    if tokens == [] or (line[-1] in sep_chars
+                        and [token.text for token in tokens] == parse_line(line + ' ')):
+        tokens.append(Token('', len(line), len(line), TOKEN_WORD))
+    return tokens
+
+
+class LineTokenizer(object):
+    """
+    tokenize() for a line edited one keystroke at a time: the scanner state
+    is saved at the token boundaries, and each new version of the line is
+    only scanned again from the last boundary before the first change
+    """
+    def __init__(self):
+        self.line = ''
+        self.tokens = []
+        self.spans = []
+
+        # Token boundaries (pos, state, number of tokens before), by position
+        self.checkpoints = [(0, line_scanner.initial_state, 0)]
+        self.positions = [0]
+
+    def tokenize(self, line):
+        """Same as tokenize(line)"""
+        self.scan(line)
+        tokens = list(self.tokens)
+        if self.new_token():
+            tokens += ['']   # This saves us some checks later
+        return tokens
+
+    def tokenize_spans(self, line):
+        """Same as tokenize_spans(line)"""
+        self.scan(line)
+        tokens = make_tokens(self.tokens, self.spans)
+        if self.new_token():
+            tokens.append(Token('', len(line), len(line), TOKEN_WORD))
+        return tokens
+
+    def scan(self, line):
+        """Scan the line again from the last boundary before the first change"""
+        # Length of the part left unchanged
+        same = min(len(self.line), len(line))
+        if not line.startswith(self.line[:same]):
+            low = 0
+            while low < same:
+                middle = (low + same + 1) // 2
+                if line[:middle] == self.line[:middle]:
+                    low = middle
+                else:
+                    same = middle - 1
+
+        index = bisect.bisect_right(self.positions, same) - 1
+        del self.checkpoints[index + 1:]
+        del self.positions[index + 1:]
+        (pos, state, count) = self.checkpoints[index]
+        self.spans = self.spans[:count]
+        self.tokens = line_scanner.scan(line, pos, state, self.tokens[:count],
+                                        self.checkpoints, self.spans)
+        self.positions.extend(checkpoint[0] for checkpoint in self.checkpoints[index + 1:])
+        self.line = line
+
+    def new_token(self):
+        """Tell whether a new (empty) token is beginning at the end of the line"""
+        line = self.line
+        return self.tokens == [] or (line[-1] in sep_chars
+                                     and self.tokens == self.scan_last(line + ' '))
+
+    def scan_last(self, line):
+        """Scan a line that extends the current one, from the last boundary"""
+        (pos, state, count) = self.checkpoints[-1]
+        return line_scanner.scan(line, pos, state, self.tokens[:count])
+
+
 def escape_special_chars_in_quotes(string):
     result = ''
     in_quotes = False
@@ -337,6 +589,224 @@ def associated_application(ext):
         return None
 
 
+class ExecutableIndex(object):
+    """
+    Index of the executables (files with a PATHEXT extension) found in the
+    PATH directories, used both for completing command names and for finding
+    the executable of a command. A directory is only listed again when its
+    modification time changes (or when PATHEXT changes); the index can be
+    saved to a file, so that it survives across sessions. Saving is done by
+    a background thread, so that it doesn't delay the callers.
+
+    The directories are checked (and listed if needed) concurrently by a
+    pool of daemon threads, so that a slow or unreachable PATH entry (e.g. a
+    mapped network drive) only delays its own listing; callers can give up
+    waiting after a timeout and use the listings available so far.
+    """
+    # Listings taken less than this many seconds after the last modification
+    # of the directory are redone next time: later changes in the same
+    # timestamp tick would go unnoticed
+    racy_interval = 2
+
+    # Maximum number of directories checked at the same time
+    max_workers = 8
+
+    def __init__(self, filename=None):
+        # File where the index is saved (None to keep it in memory only)
+        self.filename = filename
+
+        # PATHEXT at the time of the listings
+        self.pathext = None
+
+        # Directory -> (mtime, {lowercase name: name})
+        self.dirs = {}
+
+        # Listings changed since the index was saved
+        self.dirty = False
+
+        # Thread saving the changed listings (None if not running)
+        self.saver = None
+
+        # Directory -> Event set once the directory is checked; the checks
+        # are queued for the worker threads
+        self.pending = {}
+        self.queue = Queue()
+        self.workers = []
+
+        self.loaded = False
+
+        # Serializes the callers; the workers only take dirs_lock, which
+        # guards dirs, dirty, pending and saver
+        self.lock = threading.Lock()
+        self.dirs_lock = threading.Lock()
+
+    def executables(self, timeout=None):
+        """
+        Return (directory, names) for each directory in the PATH, in order;
+        the names are those of the executables in that directory. Returns a
+        pair (listings, complete): complete is False if some directories
+        could not be checked within timeout (seconds), their listings are
+        missing.
+        """
+        with self.lock:
+            (listings, complete) = self._refresh(timeout)
+        return ([(d, list(names.values())) for (d, names) in listings], complete)
+
+    def find(self, name, extensions):
+        """
+        Return the full path of the first executable name + extension in the
+        PATH directories (None if not found)
+        """
+        with self.lock:
+            (listings, _) = self._refresh()
+        for (d, names) in listings:
+            for e in extensions:
+                if (name + e).lower() in names:
+                    return os.path.join(d, name) + e
+        return None
+
+    def _refresh(self, timeout=None):
+        """
+        Update the listings of the PATH directories, return them in order
+        (see executables())
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        if not self.loaded:
+            self._load()
+        pathext = os.environ.get('PATHEXT', '')
+        if pathext != self.pathext:
+            with self.dirs_lock:
+                self.pathext = pathext
+                self.dirs = {}
+
+        dirs = [expand_env_vars(elem) for elem in os.environ['PATH'].split(os.pathsep) if elem]
+        checks = [(d, self._check(d)) for d in dirs]
+
+        listings = []
+        complete = True
+        for (d, checked) in checks:
+            if not checked.wait(None if deadline is None else max(deadline - time.time(), 0)):
+                complete = False
+                continue
+            with self.dirs_lock:
+                cached = self.dirs.get(d)
+            if cached is not None:
+                listings.append((d, cached[1]))
+
+        with self.dirs_lock:
+            if self.dirty and self.filename and self.saver is None:
+                self.saver = threading.Thread(target=self._save_changes, name='ExecutableIndex save')
+                self.saver.daemon = True
+                self.saver.start()
+        return (listings, complete)
+
+    def flush(self, timeout=None):
+        """Wait until the changed listings are saved"""
+        with self.dirs_lock:
+            saver = self.saver
+        if saver is not None:
+            saver.join(timeout)
+
+    def _check(self, d):
+        """Queue a check of a directory (unless already queued), return its Event"""
+        with self.dirs_lock:
+            checked = self.pending.get(d)
+            if checked is None:
+                checked = threading.Event()
+                self.pending[d] = checked
+                self.queue.put((d, self.pathext, checked))
+                if len(self.workers) < min(self.max_workers, len(self.pending)):
+                    worker = threading.Thread(target=self._work, name='ExecutableIndex')
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+        return checked
+
+    def _work(self):
+        """Worker thread: check the queued directories"""
+        while True:
+            (d, pathext, checked) = self.queue.get()
+            try:
+                self._list(d, pathext)
+            finally:
+                with self.dirs_lock:
+                    del self.pending[d]
+                checked.set()
+
+    def _list(self, d, pathext):
+        """List a directory if it changed since the last listing"""
+        try:
+            mtime = os.stat(d).st_mtime
+            with self.dirs_lock:
+                cached = self.dirs.get(d)
+            if cached is not None and cached[0] == mtime:
+                return
+            start = time.time()
+            extensions = pathext.lower().split(os.pathsep)
+            names = dict([(elem.name.lower(), elem.name) for elem in os.scandir(d)
+                          if os.path.splitext(elem.name)[1].lower() in extensions
+                          and elem.is_file()])
+            cached = (mtime if start - mtime >= self.racy_interval else None, names)
+        except OSError:
+            # Missing or cannot list, probably access denied
+            cached = None
+        with self.dirs_lock:
+            if pathext != self.pathext:
+                # PATHEXT changed in the meantime
+                return
+            if cached is None:
+                self.dirty = self.dirs.pop(d, None) is not None or self.dirty
+            else:
+                # A listing that must be redone anyway is not worth saving
+                # unless the names changed
+                previous = self.dirs.get(d)
+                self.dirs[d] = cached
+                self.dirty = (previous is None or previous[1] != cached[1]
+                              or cached[0] is not None or self.dirty)
+
+    def _load(self):
+        """Read the index saved by an earlier session"""
+        self.loaded = True
+        if self.filename and os.path.isfile(self.filename):
+            try:
+                with open(self.filename, 'r') as index_file:
+                    saved = json.load(index_file)
+                with self.dirs_lock:
+                    self.pathext = saved['pathext']
+                    self.dirs = dict([(d, (mtime, names)) for (d, mtime, names) in saved['dirs']])
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                # Damaged, start over
+                self.pathext = None
+                self.dirs = {}
+
+    def _save_changes(self):
+        """Saver thread: save the index until no listing changes meanwhile"""
+        while True:
+            with self.dirs_lock:
+                if not self.dirty:
+                    self.saver = None
+                    return
+            self._save()
+
+    def _save(self):
+        """Save the index for the next sessions"""
+        with self.dirs_lock:
+            saved = {'pathext': self.pathext,
+                     'dirs': [(d, mtime, names) for (d, (mtime, names)) in self.dirs.items()]}
+            self.dirty = False
+        try:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as index_file:
+                json.dump(saved, index_file)
+            os.replace(temp_filename, self.filename)
+        except (IOError, OSError):
+            pass
+
+
+# The executables in the PATH
+executable_index = ExecutableIndex()
+
+
 def full_executable_path(app_unicode):
     """
     Compute the full path of the executable that will be spawned 
@@ -366,11 +836,18 @@ def full_executable_path(app_unicode):
 
     # Search for an app
     # print('D:', paths_to_search, 'N:', name, 'E:', extensions_to_search)
+    use_index = not dir and all([e.lower() in exec_extensions for e in extensions_to_search])
+    if use_index:
+        # The executables in the PATH are indexed, only probe the current
+        # directory
+        paths_to_search = paths_to_search[:1]
     for p in paths_to_search:
         for e in extensions_to_search:
             full_path = os.path.join(p, name) + e
             if os.path.exists(full_path):
                 return full_path
+    if use_index:
+        return executable_index.find(name, extensions_to_search)
 
     # We could not find the executable; this might be an internal command,
     # or a file that doesn't have a registered application
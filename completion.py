@@ -6,10 +6,297 @@
 
 from __future__ import print_function
 
-import sys, os, re, time
-from common import tokenize, expand_env_vars, has_exec_extension, strip_extension
+import sys, os, re, time, threading
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from common import tokenize_spans, expand_env_vars, has_exec_extension, strip_extension
 from common import contains_special_char, starts_with_special_char
-from common import sep_chars, seq_tokens
+from common import sep_chars, seq_tokens, executable_index
+
+if sys.version_info[0] == 2:
+    from Queue import Queue
+else:
+    from queue import Queue
+
+# An entry of a cached directory listing
+DirEntry = namedtuple('DirEntry', ['name', 'is_dir', 'is_file'])
+
+class DirectoryCache(object):
+    """
+    LRU cache of directory listings, shared by the completion functions; a
+    listing is reused for as long as the modification time of the directory
+    doesn't change, so that completing again (or on every keystroke, for the
+    suggestions) doesn't list the directory over and over
+    """
+    # Listings taken less than this many seconds after the last modification
+    # of the directory are not cached: later changes in the same timestamp
+    # tick would go unnoticed
+    racy_interval = 2
+
+    def __init__(self, max_dirs=128, max_entries=100000):
+        self.max_dirs = max_dirs
+        self.max_entries = max_entries
+
+        # Normalized path -> (mtime, list of DirEntry), least recently used first
+        self.listings = OrderedDict()
+        self.entries = 0
+
+        # Serializes the threads completing (see Completer)
+        self.lock = threading.Lock()
+
+    def list(self, path, timeout=None):
+        """
+        Return the entries of a directory as a pair (listing, complete)
+        (raises OSError if it can't be listed); if listing it takes longer
+        than timeout, the entries found so far are returned and complete is
+        False
+        """
+        key = os.path.normcase(os.path.abspath(path))
+        mtime = os.stat(path).st_mtime
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached and cached[0] == mtime:
+                self.listings.move_to_end(key)
+                return (cached[1], True)
+
+        start = time.time()
+        listing = []
+        for elem in os.scandir(path):
+            listing.append(DirEntry(elem.name, elem.is_dir(), elem.is_file()))
+            if timeout is not None and time.time() - start > timeout:
+                # Don't keep partial listings
+                return (listing, False)
+
+        with self.lock:
+            self._forget(key)
+            if start - mtime >= self.racy_interval:
+                self.listings[key] = (mtime, listing)
+                self.entries += len(listing)
+                while self.listings and (len(self.listings) > self.max_dirs
+                                         or self.entries > self.max_entries):
+                    self._forget(next(iter(self.listings)))
+        return (listing, True)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+            self.entries = 0
+
+    def _forget(self, key):
+        cached = self.listings.pop(key, None)
+        if cached:
+            self.entries -= len(cached[1])
+
+
+# The directory listings used by the completion functions
+dir_cache = DirectoryCache()
+
+
+class CompletionList(list):
+    """
+    List of completions; incomplete is set when some directories could not
+    be listed before the deadline (the completions found there are missing)
+    """
+    incomplete = False
+
+
+class CompletionLine(object):
+    """
+    The line being completed, as seen by all the interpretations tried for a
+    single completion (simple, alternate, wildcard): the line is tokenized
+    once, and each string expanded and each directory listed and matched at
+    most once
+    """
+    def __init__(self, line, cancelled=None):
+        self.line = line
+        self.spans = tokenize_spans(line)
+        self.tokens = [token.text for token in self.spans]
+
+        # Event set when the result is no longer needed: the directories
+        # not listed yet are then skipped
+        self.cancelled = cancelled
+
+        # String -> expanded string
+        self.expanded = {}
+
+        # Directory -> (listing, complete)
+        self.listings = {}
+
+        # (directory, prefix) -> (matching entries, complete)
+        self.matches = {}
+
+    def expand(self, s):
+        """Expand the environment variables in a string"""
+        if not s in self.expanded:
+            self.expanded[s] = expand_env_vars(s)
+        return self.expanded[s]
+
+    def locate(self, token, path_sep):
+        """
+        Split a token into the path to complete and the prefix of the name;
+        return them along with the directory to list
+        """
+        (path_to_complete, _, prefix) = token.rpartition(path_sep)
+        if path_to_complete == '' and token != '' and token[0] == path_sep:
+            path_to_complete = path_sep
+
+        if path_to_complete == '':
+            dir_to_complete = os.getcwd()
+        elif path_to_complete == path_sep:
+            dir_to_complete = os.getcwd()[0:3]
+        else:
+            dir_to_complete = self.expand(path_to_complete) + path_sep
+        return (path_to_complete, prefix, dir_to_complete)
+
+    def match(self, dir_to_complete, prefix, deadline=None):
+        """
+        Return the entries of a directory that match prefix + '*', as a pair
+        (entries, complete); complete is False if the directory could not be
+        listed completely before the deadline
+        """
+        key = (dir_to_complete, prefix)
+        if not key in self.matches:
+            if not dir_to_complete in self.listings:
+                self.listings[dir_to_complete] = ([], True)
+                if self.cancelled is not None and self.cancelled.is_set():
+                    self.listings[dir_to_complete] = ([], False)
+                elif os.path.isdir(dir_to_complete):
+                    try:
+                        self.listings[dir_to_complete] = dir_cache.list(dir_to_complete,
+                                                                        remaining(deadline))
+                    except OSError:
+                        # Cannot complete, probably access denied
+                        pass
+            (listing, complete) = self.listings[dir_to_complete]
+            matcher = wildcard_to_regex(prefix + '*')
+            self.matches[key] = ([elem for elem in listing if matcher.match(elem.name)], complete)
+        return self.matches[key]
+
+
+def remaining(deadline):
+    """Return the time left until deadline (None if there is no deadline)"""
+    return None if deadline is None else max(deadline - time.time(), 0)
+
+
+def complete(line, timeout=None, cancelled=None):
+    """
+    Complete the last token of the line, which can be the name of an
+    environment variable, a wildcard or the name of a file/directory (see
+    complete_env_var, complete_wildcard and complete_file)
+
+    The return value is a tuple containing the updated line and a
+    CompletionList of possible subsequent completions; setting the cancelled
+    Event (if any) makes the completion give up early
+    """
+    parsed = CompletionLine(line, cancelled)
+    token = parsed.tokens[-1]
+    if token.strip('"').count('%') % 2 == 1:
+        (completed, completions) = _complete_env_var(parsed)
+    elif has_wildcards(token):
+        (completed, completions) = _complete_wildcard(parsed)
+    else:
+        return _complete_file(parsed, timeout)
+    return (completed, CompletionList(completions))
+
+
+
+class CompletionRequest(object):
+    """
+    A completion computed in the background by a Completer; the result is
+    meant for the line it was requested for, and is dropped if the request
+    gets cancelled
+    """
+    def __init__(self, line, timeout=None, delay=0):
+        self.line = line
+        self.timeout = timeout
+
+        # Time to wait before starting, in case the request gets cancelled
+        # meanwhile (debouncing)
+        self.delay = delay
+
+        # Set when the result is no longer needed
+        self.cancelled = threading.Event()
+
+        # Set when the result (or error) is available
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def cancel(self):
+        """Drop the request (stops the completion early if already started)"""
+        self.cancelled.set()
+
+    def wait(self, timeout=None):
+        """Wait for the result, return True if available"""
+        return self.done.wait(timeout)
+
+    def valid(self, line):
+        """Tell whether the result is available and still applies to line"""
+        return self.done.is_set() and not self.cancelled.is_set() and line == self.line
+
+    def get(self):
+        """Return the result of complete() (raises its exception, if any)"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Completer(object):
+    """
+    Compute the completions on a worker thread, so that reading the keyboard
+    can go on meanwhile; only the latest request matters, requesting a new
+    completion cancels the pending one
+    """
+    def __init__(self):
+        # Requests to process (CompletionRequest)
+        self.queue = Queue()
+        self.pending = None
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def request(self, line, timeout=None, delay=0):
+        """
+        Start completing a line (after delay seconds), return the
+        CompletionRequest
+        """
+        request = CompletionRequest(line, timeout, delay)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.cancel()
+            self.pending = request
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._work, name='Completer')
+                self.worker.daemon = True
+                self.worker.start()
+        self.queue.put(request)
+        return request
+
+    def cancel(self):
+        """Cancel the pending request (if any)"""
+        with self.lock:
+            if self.pending is not None:
+                self.pending.cancel()
+                self.pending = None
+
+    def _work(self):
+        """Worker thread: process the requests that are still wanted"""
+        while True:
+            request = self.queue.get()
+            if not request.cancelled.wait(request.delay):
+                try:
+                    request.result = complete(request.line, request.timeout, request.cancelled)
+                except Exception as error:
+                    request.error = error
+            request.done.set()
+            with self.lock:
+                if self.pending is request:
+                    self.pending = None
+
+
+# The completions requested from the prompt
+completer = Completer()
+
 
 def complete_file(line, timeout=None):
     """
@@ -26,15 +313,21 @@ def complete_file(line, timeout=None):
 
       The return value is a tuple containing 
        a) the updated line (includes the completed suffix and quotes if needed) 
-       b) and a list of possible subsequent completions
+       b) and a list of possible subsequent completions (a CompletionList,
+       incomplete if the timeout expired first)
     """
-    start = time.time()
-    (completed, completions) = complete_file_simple(line, timeout)
-    if completed == line and completions == []:
+    return _complete_file(CompletionLine(line), timeout)
+
+def _complete_file(parsed, timeout):
+    # A single deadline for both approaches
+    deadline = None if timeout is None else time.time() + timeout
+
+    (completed, completions) = _complete_file_simple(parsed, deadline)
+    if completed == parsed.line and completions == []:
         # Try the alternate completion
-        if timeout is not None:
-            timeout -= time.time() - start
-        (completed, completions) = complete_file_alternate(line, timeout)
+        (completed, alternate_completions) = _complete_file_alternate(parsed, deadline)
+        if alternate_completions or not completions.incomplete:
+            completions = alternate_completions
 
     return (completed, completions)
 
@@ -46,65 +339,43 @@ def complete_file_simple(line, timeout=None):
     
     It returns a pair:
       - the line expanded up to the longest common sequence among the
-        completions
-      - the list of all possible completions (first dirs, then files)
+        completions (unchanged if they are incomplete: the missing ones
+        might not share it)
+      - the list of all possible completions (first dirs, then files), a
+        CompletionList flagged as incomplete if the directory listing and
+        the PATH scan didn't finish within timeout
     """
-    tokens = tokenize(line)
+    return _complete_file_simple(CompletionLine(line),
+                                 None if timeout is None else time.time() + timeout)
+
+def _complete_file_simple(parsed, deadline):
+    tokens = parsed.tokens
     token = tokens[-1].replace('"', '')
 
-    pos_fwd = expand_env_vars(token).rfind('/')
-    pos_bck = expand_env_vars(token).rfind('\\')
+    pos_fwd = parsed.expand(token).rfind('/')
+    pos_bck = parsed.expand(token).rfind('\\')
     path_sep = '\\' if pos_bck >= pos_fwd else '/'
     
-    (path_to_complete, _, prefix) = token.rpartition(path_sep)
-    if path_to_complete == '' and token != '' and token[0] == path_sep:
-        path_to_complete = path_sep
+    (path_to_complete, prefix, dir_to_complete) = parsed.locate(token, path_sep)
 
-    # print('\n\n', path_to_complete, '---', prefix, '\n\n')
-
-    if path_to_complete == '':
-        dir_to_complete = os.getcwd()
-    elif path_to_complete == path_sep:
-        dir_to_complete = os.getcwd()[0:3]
-    else:
-        dir_to_complete = expand_env_vars(path_to_complete) + path_sep
-
-    # This is the wildcard matcher used throughout the function
-    matcher = wildcard_to_regex(prefix + '*')
-
-    start = time.time()
-    completions_dirs = []
-    completions_files = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            for elem in os.scandir(dir_to_complete):
-                if matcher.match(elem.name):
-                    if elem.is_dir():
-                        completions_dirs.append(elem.name + path_sep)
-                    else:
-                        completions_files.append(elem.name)
-                if timeout is not None and time.time() - start > timeout:
-                    return (line, [])
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-    completions = completions_dirs + completions_files
+    (entries, complete) = parsed.match(dir_to_complete, prefix, deadline)
+    completions = CompletionList([elem.name + path_sep for elem in entries if elem.is_dir] +
+                                 [elem.name for elem in entries if not elem.is_dir])
+    completions.incomplete = not complete
 
     if (len(tokens) == 1 or tokens[-2] in seq_tokens) and path_to_complete == '':
         # We are at the beginning of a command ==> also complete from the path
+        matcher = wildcard_to_regex(prefix + '*')
         completions_path = []
-        for elem_in_path in os.environ['PATH'].split(';'):
-            dir_to_complete = expand_env_vars(elem_in_path) + path_sep
-            try:                
-                completions_path += [elem.name for elem in os.scandir(dir_to_complete)
-                                     if matcher.match(elem.name)
-                                     and elem.is_file()
-                                     and has_exec_extension(elem.name)
-                                     and not elem.name in completions
-                                     and not elem.name in completions_path]
-            except OSError:
-                # Cannot complete, probably access denied
-                pass
+        (executables, complete) = executable_index.executables(remaining(deadline))
+        if not complete:
+            completions.incomplete = True
+        seen = set(completions)
+        for (_, names) in executables:
+            for name in names:
+                if not name in seen and matcher.match(name):
+                    completions_path.append(name)
+                    seen.add(name)
 
         # Add internal commands
         internal_commands = ['assoc',
@@ -125,71 +396,61 @@ def complete_file_simple(line, timeout=None):
             internal_commands.append('mklink')
         completions_path += [elem for elem in internal_commands
                              if matcher.match(elem)
-                             and not elem in completions
-                             and not elem in completions_path]
+                             and not elem in seen]
 
 
         # Sort in lexical order (case ignored)
         completions_path.sort(key=str.lower)
 
         # Remove .com, .exe or .bat extension where possible
-        completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
-        completions_path_nice = []
-        for i in range(0, len(completions_path_no_ext)):
-            similar = [elem for elem in completions_path_no_ext if elem == completions_path_no_ext[i]]
-            similar += [elem for elem in completions if strip_extension(elem) == completions_path_no_ext[i]]
-            if len(similar) == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
-                # No similar executables, don't use extension
-                completions_path_nice.append(completions_path_no_ext[i])
-            else:
-                # Similar executables found, keep extension
-                completions_path_nice.append(completions_path[i])
-        completions += completions_path_nice
+        completions += strip_exec_extensions(completions_path, completions, prefix)
 
-    if completions != []:
+    if completions != [] and not completions.incomplete:
         # Find the longest common sequence
         common_string = find_common_prefix(prefix, completions)
-            
-        if path_to_complete == '':
-            completed_file = common_string
-        elif path_to_complete == path_sep:
-            completed_file = path_sep + common_string
-        else:
-            completed_file = path_to_complete + path_sep + common_string
-
-        if expand_env_vars(completed_file).find(' ') >= 0 or \
-                (prefix != '' and [elem for elem in completions if contains_special_char(elem)] != []) or \
-                (prefix == '' and [elem for elem in completions if starts_with_special_char(elem)] != []):
-            # We add quotes if one of the following holds:
-            #   * the (env-expanded) completed string contains whitespace
-            #   * there is a prefix and at least one of the valid completions contains whitespace
-            #   * there is no prefix and at least one completion _starts_ with whitespace
-            start_quote = '"'
-        else:
-            start_quote = ''
+        completed_file = join_path(path_to_complete, path_sep, common_string)
+        start_quote = quote_for(parsed.expand(completed_file), prefix, completions)
 
         # Build the result
-        result = line[0 : len(line) - len(tokens[-1])] + start_quote + completed_file
+        result = parsed.line[:parsed.spans[-1].start] + start_quote + completed_file
 
         if len(completions) == 1:
             # We can close the quotes if we have completed to a unique filename
-            if start_quote == '"':
-                end_quote = '"'
-            else:
-                end_quote = ''
-                
-            if result[-1] == path_sep:
-                # Directory -- we want the backslash (if any) AFTER the closing quote
-                result = result[ : -1] + end_quote + path_sep
-            else:
-                # File -- add space if the completion is unique
-                result += end_quote
-                result += ' '
+            result = close_quote(result, start_quote, path_sep)
 
         return (result, completions)
     else:
-        # No expansion was made, return original line
-        return (line, [])
+        # No expansion was made (or the completions are incomplete), return
+        # original line
+        return (parsed.line, completions)
+
+
+def strip_exec_extensions(completions_path, completions, prefix):
+    """
+    Return the "nice" names of the executables found in the PATH: the
+    extension is dropped unless another executable in the PATH or a file
+    or directory among the completions has the same name without extension
+    (or the prefix already reaches into the extension)
+    """
+    # Bucket the names by their extension-less form
+    completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
+    similar = {}
+    for elem in completions_path_no_ext:
+        similar[elem] = similar.get(elem, 0) + 1
+    for elem in completions:
+        elem = strip_extension(elem)
+        if elem in similar:
+            similar[elem] += 1
+
+    completions_path_nice = []
+    for (elem, elem_no_ext) in zip(completions_path, completions_path_no_ext):
+        if similar[elem_no_ext] == 1 and has_exec_extension(elem) and len(prefix) < len(elem) - 3:
+            # No similar executables, don't use extension
+            completions_path_nice.append(elem_no_ext)
+        else:
+            # Similar executables found, keep extension
+            completions_path_nice.append(elem)
+    return completions_path_nice
 
 
 def complete_file_alternate(line, timeout=None):
@@ -201,85 +462,47 @@ def complete_file_alternate(line, timeout=None):
     
     It returns a pair:
       - the line expanded up to the longest common sequence among the
-        completions
-      - the list of all possible completions (first dirs, then files)
+        completions (unchanged if they are incomplete)
+      - the list of all possible completions (first dirs, then files), a
+        CompletionList flagged as incomplete if the directory listing didn't
+        finish within timeout
     """
-    tokens = tokenize(line)
+    return _complete_file_alternate(CompletionLine(line),
+                                    None if timeout is None else time.time() + timeout)
+
+def _complete_file_alternate(parsed, deadline):
+    tokens = parsed.tokens
     (last_token_prefix, equal_char, last_token) = tokens[-1].replace('"', '').rpartition('=')
     last_token_prefix += equal_char
         
     paths = last_token.split(';')
     token = paths[-1]
 
-    path_sep = '/' if '/' in expand_env_vars(token) else '\\'
-
-    # print('\n\nTokens:', tokens, '\n\nCompleting:', token, '\n\n')
-
-    (path_to_complete, _, prefix) = token.rpartition(path_sep)
-    if path_to_complete == '' and token != '' and token[0] == path_sep:
-        path_to_complete = path_sep
-
-    # print('\n\n', path_to_complete, '---', prefix, '\n\n')
-
-    if path_to_complete == '':
-        dir_to_complete = os.getcwd()
-    elif path_to_complete == path_sep:
-        dir_to_complete = os.getcwd()[0:3]
-    else:
-        dir_to_complete = expand_env_vars(path_to_complete) + path_sep
+    path_sep = '/' if '/' in parsed.expand(token) else '\\'
 
-    # This is the wildcard matcher used throughout the function
-    matcher = wildcard_to_regex(prefix + '*')
+    (path_to_complete, prefix, dir_to_complete) = parsed.locate(token, path_sep)
 
-    start = time.time()
-    completions_dirs = []
-    completions_files = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            for elem in os.scandir(dir_to_complete):
-                if matcher.match(elem.name):
-                    if elem.is_dir():
-                        completions_dirs.append(elem.name + path_sep)
-                    else:
-                        completions_files.append(elem.name)
-                if timeout is not None and time.time() - start > timeout:
-                    return (line, [])
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-    completions = completions_dirs + completions_files
+    (entries, complete) = parsed.match(dir_to_complete, prefix, deadline)
+    completions = CompletionList([elem.name + path_sep for elem in entries if elem.is_dir] +
+                                 [elem.name for elem in entries if not elem.is_dir])
+    completions.incomplete = not complete
 
-    if completions != []:
+    if completions != [] and not completions.incomplete:
         # Find the longest common sequence
         common_string = find_common_prefix(prefix, completions)
-            
-        if path_to_complete == '':
-            completed_file = common_string
-        elif path_to_complete == path_sep:
-            completed_file = path_sep + common_string
-        else:
-            completed_file = path_to_complete + path_sep + common_string
-
-        if expand_env_vars(last_token + completed_file).find(' ') >= 0 or \
-                (prefix != '' and [elem for elem in completions if contains_special_char(elem)] != []) or \
-                (prefix == '' and [elem for elem in completions if starts_with_special_char(elem)] != []):
-            # We add quotes if one of the following holds:
-            #   * the (env-expanded) completed string contains whitespace
-            #   * there is a prefix and at least one of the valid completions contains whitespace
-            #   * there is no prefix and at least one completion _starts_ with whitespace
-            start_quote = '"'
-        else:
-            start_quote = ''
+        completed_file = join_path(path_to_complete, path_sep, common_string)
+        start_quote = quote_for(parsed.expand(last_token + completed_file), prefix, completions)
 
         # Build and return the result
-        result = line[0 : len(line) - len(tokens[-1])]
+        result = parsed.line[:parsed.spans[-1].start]
         result += last_token_prefix + start_quote
         result += last_token[:len(last_token) - len(token)]
         result += completed_file
         return (result, completions)
     else:
-        # No expansion was made, return original line
-        return (line, [])
+        # No expansion was made (or the completions are incomplete), return
+        # original line
+        return (parsed.line, completions)
 
 
 def complete_wildcard(line):
@@ -293,39 +516,23 @@ def complete_wildcard(line):
         completions
       - the list of all possible completions (first dirs, then files)
     """
-    tokens = tokenize(line)
+    return _complete_wildcard(CompletionLine(line))
+
+def _complete_wildcard(parsed):
+    tokens = parsed.tokens
     token = tokens[-1].replace('"', '')
 
-    path_sep = '/' if '/' in expand_env_vars(token) else '\\'
+    path_sep = '/' if '/' in parsed.expand(token) else '\\'
     
-    (path_to_complete, _, prefix) = token.rpartition(path_sep)
-    if path_to_complete == '' and token != '' and token[0] == path_sep:
-        path_to_complete = path_sep
-
-    # print('\n\n', path_to_complete, '---', prefix, '\n\n')
-
-    if path_to_complete == '':
-        dir_to_complete = os.getcwd()
-    elif path_to_complete == path_sep:
-        dir_to_complete = os.getcwd()[0:3]
-    else:
-        dir_to_complete = expand_env_vars(path_to_complete) + path_sep
+    (path_to_complete, prefix, dir_to_complete) = parsed.locate(token, path_sep)
 
     # This is the wildcard matcher used throughout the function
     matcher = wildcard_to_regex(prefix + '*')
 
-    completions = []
-    if os.path.isdir(dir_to_complete):
-        try:
-            completions = [elem for elem in os.scandir(dir_to_complete) if matcher.match(elem.name)]
-        except OSError:
-            # Cannot complete, probably access denied
-            pass
-
-
     # Sort directories first, also append '\'; then, files
-    completions_dirs = [elem.name + path_sep for elem in completions if elem.is_dir()]
-    completions_files = [elem.name for elem in completions if elem.is_file()]
+    (entries, _) = parsed.match(dir_to_complete, prefix)
+    completions_dirs = [elem.name + path_sep for elem in entries if elem.is_dir]
+    completions_files = [elem.name for elem in entries if elem.is_file]
     completions = completions_dirs + completions_files
 
     if completions != []:
@@ -340,50 +547,60 @@ def complete_wildcard(line):
         else:
             # Multiple matches, find the longest common sequence
             common_string = prefix + find_common_prefix(prefix, completed_suffixes)
-            
-        if path_to_complete == '':
-            completed_file = common_string
-        elif path_to_complete == path_sep:
-            completed_file = path_sep + common_string
-        else:
-            completed_file = path_to_complete + path_sep + common_string
-
-
-        if expand_env_vars(completed_file).find(' ') >= 0 or \
-                (prefix != '' and [elem for elem in completions if contains_special_char(elem)] != []) or \
-                (prefix == '' and [elem for elem in completions if starts_with_special_char(elem)] != []):
-            # We add quotes if one of the following holds:
-            #   * the (env-expanded) completed string contains whitespace
-            #   * there is a prefix and at least one of the valid completions contains whitespace
-            #   * there is no prefix and at least one completion _starts_ with whitespace
-            start_quote = '"'
-        else:
-            start_quote = ''
+        completed_file = join_path(path_to_complete, path_sep, common_string)
+        start_quote = quote_for(parsed.expand(completed_file), prefix, completions)
 
         # Build the result
-        result = line[0 : len(line) - len(tokens[-1])] + start_quote + completed_file
+        result = parsed.line[:parsed.spans[-1].start] + start_quote + completed_file
         if len(completions) == 1 or \
                 not common_string.endswith('*') and \
                 max([len(c) for c in completed_suffixes]) == len(common_string) - len(prefix):
             # We can close the quotes if all the completions have the same suffix or 
             # there exists only one matching file
-            if start_quote == '"':
-                end_quote = '"'
-            else:
-                end_quote = ''
-                
-            if result[-1] == path_sep:
-                # Directory -- we want the backslash (if any) AFTER the closing quote
-                result = result[ : -1] + end_quote + path_sep
-            else:
-                # File -- add space if the completion is unique
-                result += end_quote
-                result += ' '
+            result = close_quote(result, start_quote, path_sep)
 
         return (result, completions)
     else:
         # No expansion was made, return original line
-        return (line, [])
+        return (parsed.line, [])
+
+
+def join_path(path_to_complete, path_sep, name):
+    """Append the completed name to the path being completed"""
+    if path_to_complete == '':
+        return name
+    elif path_to_complete == path_sep:
+        return path_sep + name
+    else:
+        return path_to_complete + path_sep + name
+
+
+def quote_for(completed_expanded, prefix, completions):
+    """
+    Return the quote to insert before the completed path ('"' or '')
+
+    We add quotes if one of the following holds:
+      * the (env-expanded) completed string contains whitespace
+      * there is a prefix and at least one of the valid completions contains whitespace
+      * there is no prefix and at least one completion _starts_ with whitespace
+    """
+    if completed_expanded.find(' ') >= 0 or \
+            (prefix != '' and [elem for elem in completions if contains_special_char(elem)] != []) or \
+            (prefix == '' and [elem for elem in completions if starts_with_special_char(elem)] != []):
+        return '"'
+    else:
+        return ''
+
+
+def close_quote(result, start_quote, path_sep):
+    """Close the quotes (if any) around a final completion"""
+    end_quote = start_quote
+    if result[-1] == path_sep:
+        # Directory -- we want the backslash (if any) AFTER the closing quote
+        return result[ : -1] + end_quote + path_sep
+    else:
+        # File -- add space if the completion is unique
+        return result + end_quote + ' '
 
 
 def complete_env_var(line):
@@ -397,7 +614,11 @@ def complete_env_var(line):
         completions
       - the list of all possible completions
     """
-    tokens = tokenize(line)
+    return _complete_env_var(CompletionLine(line))
+
+def _complete_env_var(parsed):
+    line = parsed.line
+    tokens = parsed.tokens
 
     # Account for the VAR=VALUE syntax
     (token_prefix, equals, token_orig) = tokens[-1].rpartition('=')
@@ -443,65 +664,52 @@ def find_common_prefix(original, completions):
     Search for the longest common prefix in a list of strings
     Returns the longest common prefix
     """
-    common_len = 0
-    common_string = ''
-    mismatch = False
-    perfect = True
-
-    # Cache lowercase version to avoid repeated calls to str.lower()
+    # The prefix (case ignored) common to all the strings is the one common
+    # to the first and last of them in lexical order
     completions_lower = [s.lower() for s in completions]
-    common_string_lower = ''
-
-    while common_len < len(completions[0]) and not mismatch:
+    first = min(completions_lower)
+    last = max(completions_lower)
+    common_len = 0
+    while common_len < len(first) and first[common_len] == last[common_len]:
         common_len += 1
-        common_string = completions[0][0:common_len]
-        common_string_lower = completions_lower[0][0:common_len]
-        for i in range(1, len(completions)):
-            completion = completions[i]
-            completion_lower = completions_lower[i]
-            if completion_lower[0:common_len] != common_string_lower:
-                mismatch = True
-            elif completion[0:common_len] != common_string:
-                perfect = False
-    if mismatch:
-        common_string = common_string[:-1]
-        common_len -= 1
-
-    # Try to take a good guess wrt letter casing
-    if not perfect:
-        for i in range(len(original)):
-            case_match = [c for c in completions if c.startswith(original[:i + 1])]
-            if len(case_match) > 0:
-                common_string = case_match[0][:common_len]
-            else:
-                break
-
-    return common_string
-
-
+    common_len = min(common_len, len(completions[0]))
+
+    # Try to take a good guess wrt letter casing: use the first completion
+    # among those that start with the longest part of the original
+    guess = completions[0]
+    guess_len = 0
+    for completion in completions:
+        if guess_len < len(original) and completion.startswith(original[:guess_len + 1]):
+            guess = completion
+            guess_len += 1
+            while guess_len < len(original) and completion.startswith(original[:guess_len + 1]):
+                guess_len += 1
+
+    return guess[:common_len]
+
+
+# Transform a wildcard pattern into a regexp (escape the special characters)
+wildcard_translations = str.maketrans({'\\': '\\\\',
+                                       '(': '\\(',
+                                       ')': '\\)',
+                                       '[': '\\[',
+                                       ']': '\\]',
+                                       '.': '\\.',
+                                       '+': '\\+',
+                                       '^': '\\^',
+                                       '$': '\\$',
+                                       '?': '(.)',
+                                       '*': '(.*)'})
+
+@lru_cache(maxsize=256)
 def wildcard_to_regex(pattern):
     """
     Transform a wildcard pattern into a compiled regex object.
     This also handles escaping as needed.    
+
+    The regexes are cached, the same patterns come back with every keystroke.
     """
-    # Transform pattern into regexp
-    translations = [('\\', '\\\\'),
-                    ('(', '\\('), 
-                    (')', '\\)'),
-                    ('[', '\\['), 
-                    (']', '\\]'),
-                    ('.', '\\.'),
-                    ('+', '\\+'),
-                    ('^', '\\^'),
-                    ('$', '\\$'),
-                    ('?', '(.)'), 
-                    ('*', '(.*)')]
-                    
-    re_pattern = pattern
-    for src, dest in translations:
-        re_pattern = re_pattern.replace(src, dest)
-    re_pattern += '$'
-    return re.compile(re_pattern, re.IGNORECASE)
+    return re.compile(pattern.translate(wildcard_translations) + '$', re.IGNORECASE)
 
 
 def has_wildcards(pattern):
@@ -170,6 +170,14 @@ def read_input():
         if record.EventType == KEY_EVENT and record.KeyDown:
             return record
 
+def input_pending():
+    """Tell whether a key press is waiting in the console input buffer"""
+    count = stdin_handle.GetNumberOfConsoleInputEvents()
+    if count == 0:
+        return False
+    return any(record.EventType == KEY_EVENT and record.KeyDown and not is_control_only(record)
+               for record in stdin_handle.PeekConsoleInput(count))
+
 def write_input(key_code, char, control_state):
     """Emulate a key press with the given key code and control key mask"""
     record = PyINPUT_RECORDType(KEY_EVENT)
@@ -316,9 +324,9 @@ def is_shift_pressed(record):
 def is_control_only(record):
     """
     Check whether this is a control-key-only press, i.e. just a modifier
-    key w/out an "actual" key
+    key (Shift, Ctrl, Alt, CapsLock, Windows) w/out an "actual" key
     """
-    return record.VirtualKeyCode in [16, 17, 18]
+    return record.VirtualKeyCode in [16, 17, 18, 20, 91, 92]
 
 # Initialization
 FOREGROUND_BLUE = 0x01
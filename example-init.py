@@ -195,6 +195,12 @@ behavior.quiet_mode = False
 #
 behavior.completion_mode = 'zsh'
 
+# Tab-completion gives up listing directories after this many seconds (the
+# PATH directories are scanned in parallel); completions from slower
+# directories (e.g. unreachable network drives in the PATH) are left out and
+# the bell rings. Set to None to always wait for all the directories.
+behavior.completion_timeout = 2
+
 # For modifying the previously fixed internal default value of 2000
 # for the command history limit.
 behavior.max_cmd_history_length = 2000
@@ -205,6 +211,25 @@ behavior.max_cmd_history_length = 2000
 # thus these entries a prefixed with a "+".
 behavior.max_dir_history_length = 9
 
+# The command and directory histories are saved to disk in the background,
+# without delaying the prompt. Records are collected for a short while
+# (history_flush_delay, in seconds) and then written together; set
+# history_fsync to True to also force each write to the disk (slower on network
+# drives and roaming profiles).
+behavior.history_flush_delay = 0.5
+behavior.history_fsync = False
+
+# Commands run in other PyCmd windows are added to the history of this one
+# (before the next prompt is displayed); set to False to keep the command
+# history of each window separate until it's restarted.
+behavior.history_share = True
+
+# The histories are saved as plain text files by default; with the 'sqlite'
+# backend, they are kept in SQLite databases (history.db, dir_history.db) that
+# also record the time, directory, exit code and duration of each command.
+# The existing history files are imported when switching to 'sqlite'.
+behavior.history_backend = 'file'
+
 # For defining a string with a fixed list of directories separated via
 # linebreaks (or alternatively a Python list of strings) which can be
 # listed and navigated just like the direcory history, but with
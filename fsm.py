@@ -11,6 +11,10 @@
 # documentation (notably the class documentation has not been updated to reflect
 # the changes, however the add_empty_transition method itself is documented to
 # explain what it is useful for.
+# Added method copy, to run a machine on several inputs without rebuilding the
+# transition tables.
+# Added method freeze, to resolve the transitions (empty transitions included)
+# once for all instead of for every input symbol.
 #
 
 """This module implements a Finite State Machine (FSM). In addition to state
@@ -108,6 +112,10 @@ class FSM:
         # Map (current_state) --> (action, next_state) without consuming symbol.
         self.state_empty_transitions = {}
         self.default_transition = None
+        # Set by freeze(): map (input_symbol, current_state) and (current_state)
+        # --> (empty actions, action, next_state).
+        self.frozen_transitions = None
+        self.frozen_transitions_any = None
 
         self.input_symbol = None
         self.initial_state = initial_state
@@ -125,6 +133,77 @@ class FSM:
         self.current_state = self.initial_state
         self.input_symbol = None
 
+    def copy (self, memory=None):
+
+        """This returns a new FSM, in the initial state and with the given
+        memory, that shares the transition tables of this one. Build the
+        transitions once, then use a copy for each input to process. """
+
+        f = FSM(self.initial_state, memory)
+        f.state_transitions = self.state_transitions
+        f.state_transitions_any = self.state_transitions_any
+        f.state_empty_transitions = self.state_empty_transitions
+        f.default_transition = self.default_transition
+        f.frozen_transitions = self.frozen_transitions
+        f.frozen_transitions_any = self.frozen_transitions_any
+        return f
+
+    def freeze (self):
+
+        """This resolves the transitions of every state, for every input symbol
+        of the transition table and for any other symbol, following the empty
+        transitions: process() then finds the actions to call and the next
+        state with a single lookup. The observable behavior is unchanged (the
+        actions of the empty transitions are called in the same order, before
+        the action of the transition). Freeze the machine once it is built:
+        adding a transition afterwards undoes the freezing, but not in the
+        copies already made. """
+
+        states = set([self.initial_state])
+        for (input_symbol, state), (action, next_state) in self.state_transitions.items():
+            states.update([state, next_state])
+        for table in [self.state_transitions_any, self.state_empty_transitions]:
+            for state, (action, next_state) in table.items():
+                states.update([state, next_state])
+        if self.default_transition is not None:
+            states.add(self.default_transition[1])
+        input_symbols = set(input_symbol for (input_symbol, state) in self.state_transitions)
+
+        # A symbol that is not in the transition table
+        other = object()
+        self.frozen_transitions_any = dict((state, self.resolve_transition(other, state))
+                                           for state in states)
+        self.frozen_transitions = dict(((input_symbol, state),
+                                        self.resolve_transition(input_symbol, state))
+                                       for input_symbol in input_symbols for state in states)
+
+    def resolve_transition (self, input_symbol, state):
+
+        """This returns (empty actions, action, next_state) given an
+        input_symbol and state, where empty actions are the actions of the
+        empty transitions followed. This calls no action. It returns None if
+        the transition is undefined or the empty transitions loop; process()
+        then leaves it to get_transition(). It is called by freeze(). """
+
+        empty_actions = []
+        visited = set()
+        while True:
+            if (input_symbol, state) in self.state_transitions:
+                return (tuple(empty_actions),) + self.state_transitions[(input_symbol, state)]
+            elif state in self.state_transitions_any:
+                return (tuple(empty_actions),) + self.state_transitions_any[state]
+            elif state in self.state_empty_transitions:
+                if state in visited:
+                    return None
+                visited.add(state)
+                (action, state) = self.state_empty_transitions[state]
+                if action is not None:
+                    empty_actions.append(action)
+            elif self.default_transition is not None:
+                return (tuple(empty_actions),) + self.default_transition
+            else:
+                return None
+
     def add_transition (self, input_symbol, state, action=None, next_state=None):
 
         """This adds a transition that associates:
@@ -141,6 +220,7 @@ class FSM:
         if next_state is None:
             next_state = state
         self.state_transitions[(input_symbol, state)] = (action, next_state)
+        self.frozen_transitions = None
 
     def add_transition_list (self, list_input_symbols, state, action=None, next_state=None):
 
@@ -175,6 +255,7 @@ class FSM:
         if next_state is None:
             next_state = state
         self.state_transitions_any [state] = (action, next_state)
+        self.frozen_transitions = None
 
     def add_empty_transition(self, state, next_state, action = None):
 
@@ -194,6 +275,7 @@ class FSM:
 
         if next_state is not None:
             self.state_empty_transitions[state] = (action, next_state)
+            self.frozen_transitions = None
 
     def set_default_transition (self, action, next_state):
 
@@ -207,6 +289,7 @@ class FSM:
         default_transition to None. """
 
         self.default_transition = (action, next_state)
+        self.frozen_transitions = None
 
     def get_transition (self, input_symbol, state):
 
@@ -254,10 +337,23 @@ class FSM:
         input_symbol and current_state. If the action is None then the action
         is not called and only the current state is changed. This method
         processes one complete input symbol. You can process a list of symbols
-        (or a string) by calling process_list(). """
+        (or a string) by calling process_list(). If the machine is frozen, the
+        transition is looked up in the tables built by freeze(). """
 
         self.input_symbol = input_symbol
-        (self.action, self.next_state) = self.get_transition (self.input_symbol, self.current_state)
+        transition = None
+        if self.frozen_transitions is not None:
+            transition = self.frozen_transitions.get((input_symbol, self.current_state), self)
+            if transition is self:
+                # Not in the transition table, any other symbol
+                transition = self.frozen_transitions_any.get(self.current_state)
+        if transition is not None:
+            (empty_actions, action, next_state) = transition
+            for empty_action in empty_actions:
+                empty_action (self)
+            (self.action, self.next_state) = (action, next_state)
+        else:
+            (self.action, self.next_state) = self.get_transition (self.input_symbol, self.current_state)
         if self.action is not None:
             self.action (self)
         self.current_state = self.next_state
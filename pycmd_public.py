@@ -501,6 +501,11 @@ class Behavior(_Settings):
 
         # Select the completion mode; currently supported: 'bash' and 'zsh'
         self.completion_mode = 'zsh'
+
+        # Maximum time (seconds) spent listing directories when completing
+        # with Tab; slow directories (e.g. on unreachable network drives) are
+        # skipped after that. None waits for all the directories
+        self.completion_timeout = 2
     
         # Maximum allowed command history length
         self.max_cmd_history_length = 2000
@@ -508,6 +513,24 @@ class Behavior(_Settings):
         # Maximum allowed directory history length (if the history
         # gets too long it becomes hard to navigate)
         self.max_dir_history_length = 9
+
+        # The command and directory histories are saved in the background;
+        # records are collected for this many seconds and then written
+        # together
+        self.history_flush_delay = 0.5
+
+        # Force the saved history records to the disk (fsync); safer, but
+        # slower on network drives and roaming profiles
+        self.history_fsync = False
+
+        # Pick up the commands run in other PyCmd windows (they are added to
+        # the command history before each prompt)
+        self.history_share = True
+
+        # Where the histories are saved: 'file' (plain text files) or
+        # 'sqlite' (SQLite databases, which also keep the time, directory,
+        # exit code and duration of each command)
+        self.history_backend = 'file'
         
         # String with a fixed list of directories separated via linebreaks
         # (or alternatively a python list of strings) which can be listed
@@ -518,6 +541,9 @@ class Behavior(_Settings):
         if not self.completion_mode in ['bash', 'zsh']:
             print('Invalid setting "' + self.completion_mode + '" for "completion_mode" -- using default "zsh"')
             self.completion_mode = 'zsh'
+        if not self.history_backend in ['file', 'sqlite']:
+            print('Invalid setting "' + self.history_backend + '" for "history_backend" -- using default "file"')
+            self.history_backend = 'file'
 
 
 # Initialize global configuration instances with default values
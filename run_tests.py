@@ -1,6 +1,7 @@
 import unittest
 from tests import common_tests, completion_tests, console_tests, command_tests
-from tests import InputState_tests, Window_tests
+from tests import InputState_tests, Window_tests, CommandHistory_tests, HistoryFile_tests
+from tests import HistoryDatabase_tests
 from tests import pycmd_public_tests
 
 def suite():
@@ -10,6 +11,9 @@ def suite():
     suite.addTest(console_tests.suite())
     suite.addTest(command_tests.suite())
     suite.addTest(InputState_tests.suite())
+    suite.addTest(CommandHistory_tests.suite())
+    suite.addTest(HistoryFile_tests.suite())
+    suite.addTest(HistoryDatabase_tests.suite())
     suite.addTest(Window_tests.suite())
     suite.addTest(pycmd_public_tests.suite())
     return suite
@@ -0,0 +1,357 @@
+#
+# Unit tests for CommandHistory.py
+#
+
+import re, random, threading
+from unittest import TestCase, TestSuite, defaultTestLoader
+from CommandHistory import CommandHistory, HistoryIndex, HistoryMatcher, PrefixTree
+
+
+def reference_filter(history, line):
+    """
+    Straightforward (one regex pass per pattern over the whole history)
+    computation of the filtered list, used as a reference for the results
+    of CommandHistory.start()
+    """
+    words = [re.escape(w) for w in re.findall('[^\\s]+', line)]
+    boundary = '[\\s]+'
+    patterns = ['^' + boundary.join(['(' + w + ')[^\\s]*' for w in words]) + '$',
+                boundary.join(['(' + w + ')[^\\s]*' for w in words])]
+    words = [re.escape(w) for w in re.findall('[a-zA-Z0-9]+', line)]
+    boundary = '[\\s\\.\\-\\\\_]+'
+    patterns += ['^' + boundary.join(['(' + w + ')[a-zA-Z0-9]*' for w in words]) + '$',
+                 boundary.join(['(' + w + ')[a-zA-Z0-9]*' for w in words]),
+                 '(' + re.escape(line) + ')',
+                 boundary.join(['(' + w + ').*' for w in words]),
+                 ''.join(['(' + w + ').*' for w in words])]
+    if len(words) <= 1:
+        patterns = [patterns[4]]
+
+    filtered = []
+    for pattern in patterns:
+        for l in reversed(history):
+            if l in [f for (f, _) in filtered]:
+                continue
+            m = re.search(pattern, l, re.IGNORECASE)
+            if m:
+                filtered.insert(0, (l, [m.span(i) for i in range(1, m.lastindex + 1)]))
+    return filtered
+
+
+class TestHistoryIndex(TestCase):
+    def setUp(self):
+        self.index = HistoryIndex()
+        for line in ['git checkout master', 'git commit -a', 'make clean']:
+            self.index.add(line)
+
+    def testCandidates(self):
+        self.assertEqual(self.index.candidates(['GIT']), set(['git checkout master', 'git commit -a']))
+        self.assertEqual(self.index.candidates(['git', 'master']), set(['git checkout master']))
+        self.assertEqual(self.index.candidates(['svn']), set())
+
+    def testShortSubstrings(self):
+        """Substrings shorter than a trigram can't restrict the search"""
+        self.assertEqual(self.index.candidates(['gi']), None)
+        self.assertEqual(self.index.candidates([]), None)
+
+    def testRemove(self):
+        self.index.remove('make clean')
+        self.assertEqual(self.index.candidates(['make']), set())
+        self.assertFalse('mak' in self.index.postings)
+
+    def testCaseFolding(self):
+        """Lines and filters that lower() can't fold like re are not narrowed down"""
+        self.index.add(u'kıakiſKK')
+        self.assertEqual(self.index.candidates([u'isk']), set([u'kıakiſKK']))
+        self.assertEqual(self.index.candidates([u'ısK']), None)
+        self.index.remove(u'kıakiſKK')
+        self.assertEqual(self.index.candidates([u'isk']), set())
+
+
+class TestHistoryMatcher(TestCase):
+    def testTiers(self):
+        matcher = HistoryMatcher('g c m')
+        self.assertEqual(matcher.match('git checkout master'), (0, [(0, 1), (4, 5), (13, 14)]))
+        self.assertEqual(matcher.match('git checkout master -f'), (1, [(0, 1), (4, 5), (13, 14)]))
+        self.assertEqual(matcher.match('xg yc zm'), (6, [(1, 2), (4, 5), (7, 8)]))
+        self.assertEqual(matcher.match('make clean'), None)
+
+    def testSimpleFilter(self):
+        """Filters with at most one word only use the substring match"""
+        matcher = HistoryMatcher('Make')
+        self.assertEqual(len(matcher.patterns), 1)
+        self.assertEqual(matcher.match('gmake clean'), (0, [(1, 5)]))
+
+
+class TestPrefixTree(TestCase):
+    def setUp(self):
+        self.tree = PrefixTree()
+        self.lines = ['make', 'make clean', 'git commit', 'git checkout', 'git', 'mak']
+        for stamp, line in enumerate(self.lines):
+            self.tree.add(line, stamp)
+
+    def testLatest(self):
+        self.assertEqual(self.tree.latest('m'), 'mak')
+        self.assertEqual(self.tree.latest('make'), 'make clean')
+        self.assertEqual(self.tree.latest('make '), 'make clean')
+        self.assertEqual(self.tree.latest('git c'), 'git checkout')
+        self.assertEqual(self.tree.latest('git com'), 'git commit')
+        self.assertEqual(self.tree.latest('git'), 'git')
+        self.assertEqual(self.tree.latest('Git'), None)
+        self.assertEqual(self.tree.latest('make cleaner'), None)
+        self.assertEqual(self.tree.latest(''), 'mak')
+
+    def testRemove(self):
+        self.tree.remove('git')
+        self.assertEqual(self.tree.latest('git'), 'git checkout')
+        self.tree.remove('git checkout')
+        self.tree.remove('make clean')
+        self.assertEqual(self.tree.latest('git'), 'git commit')
+        self.assertEqual(self.tree.latest('make'), 'make')
+        self.assertEqual(self.tree.latest('make '), None)
+        self.tree.remove('not there')
+        self.tree.remove('ma')
+        self.assertEqual(self.tree.latest('ma'), 'mak')
+
+    def testRandomized(self):
+        """Compare against a scan of the lines for random updates"""
+        rand = random.Random(0)
+        tree = PrefixTree()
+        lines = []
+        for stamp in range(2000):
+            line = ''.join(rand.choice('ab c') for i in range(rand.randint(0, 6)))
+            if rand.random() < 0.3 and lines:
+                line = rand.choice(lines)
+                tree.remove(line)
+                lines.remove(line)
+            else:
+                if line in lines:
+                    lines.remove(line)
+                lines.append(line)
+                tree.add(line, stamp)
+            prefix = line[:rand.randint(0, len(line))] + rand.choice(['', 'a', 'b'])
+            expected = [l for l in reversed(lines) if l.startswith(prefix)]
+            self.assertEqual(tree.latest(prefix), expected[0] if expected else None)
+
+
+class TestCommandHistory(TestCase):
+    lines = ['dir',
+             'git checkout master',
+             'cd ~\\work\\pycmd',
+             'git commit -a -m "Fix gc"',
+             'make clean',
+             'git_cm.bat',
+             'echo "git checkout"',
+             'gcc -c main.c',
+             'cd ..',
+             'git checkout main',
+             'notepad CommandHistory.py']
+
+    filters = ['', 'g', 'git', 'g c m', 'git c', 'gi ch', 'c', 'cd',
+               'cd .', 'make', 'MAKE', 'py', 'g.c', 'git-c', 'xyz', '"git', ' ']
+
+    def setUp(self):
+        self.history = CommandHistory(lazy=False)
+        self.history.list = list(self.lines)
+
+    def testFilteredList(self):
+        """The filtered list matches the tiered ordering of the regex patterns"""
+        for f in self.filters:
+            self.history.start(f)
+            self.assertEqual(self.history.filtered_list, reference_filter(self.lines, f), f)
+
+    def testCaseFolding(self):
+        """The index doesn't drop the lines that only match thanks to the re case folding"""
+        rand = random.Random(0)
+        alphabet = u'iIısSſkKKµμ -.'
+        lines = [u''.join(rand.choice(alphabet) for i in range(rand.randint(3, 8)))
+                 for j in range(200)]
+        self.history.list = lines
+        lines = list(self.history.list)
+        for i in range(300):
+            f = u''.join(rand.choice(alphabet) for i in range(rand.randint(3, 5)))
+            self.history.start(f)
+            self.assertEqual(self.history.filtered_list, reference_filter(lines, f), f)
+
+    def testNavigation(self):
+        self.history.start('git c')
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'git checkout main')
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'echo "git checkout"')
+        self.assertTrue(self.history.down())
+        self.assertEqual(self.history.current()[0], 'git checkout main')
+        self.assertTrue(self.history.down())
+        self.assertEqual(self.history.current(), ('git c', [(0, 5)]))
+
+    def testNarrowing(self):
+        """Refined filters give the same results as new searches"""
+        for f in ['g', 'gi', 'git', 'git ', 'git c', 'git ch', 'git ch m', 'git ch ma']:
+            self.history.start(f)
+            self.assertEqual(self.history.filtered_list, reference_filter(self.lines, f), f)
+        for f in ['cd', 'cd.', 'cd..', 'cd', 'c']:
+            self.history.start(f)
+            self.assertEqual(self.history.filtered_list, reference_filter(self.lines, f), f)
+
+    def testNarrowingAfterAdd(self):
+        self.history.start('git')
+        self.history.add('git status')
+        self.history.start('git s')
+        self.assertEqual(self.history.filtered_list[-1][0], 'git status')
+
+    def testAdd(self):
+        self.history.add('git checkout master')
+        self.history.add('svn update')
+        self.assertEqual(self.history.list[-2:], ['git checkout master', 'svn update'])
+        self.assertEqual(self.history.list.count('git checkout master'), 1)
+        self.history.start('git ch')
+        self.assertEqual(self.history.filtered_list[-1][0], 'git checkout master')
+        self.history.start('svn')
+        self.assertEqual([l for (l, _) in self.history.filtered_list], ['svn update'])
+
+    def testListView(self):
+        view = self.history.list
+        self.assertEqual(len(view), len(self.lines))
+        self.assertEqual(view, self.lines)
+        self.assertEqual(view[0], 'dir')
+        self.assertEqual(view[-1], 'notepad CommandHistory.py')
+        self.assertEqual(view[-3], 'cd ..')
+        self.assertEqual(list(reversed(view)), list(reversed(self.lines)))
+        self.assertTrue('make clean' in view)
+        self.assertFalse('make' in view)
+        self.assertRaises(IndexError, lambda: view[len(self.lines)])
+
+    def testDuplicates(self):
+        """Duplicate lines are only kept once, at their most recent position"""
+        self.history.list = ['a', 'b', 'a', 'c']
+        self.assertEqual(self.history.list, ['b', 'a', 'c'])
+
+    def testLatest(self):
+        self.assertEqual(self.history.latest('git c'), 'git checkout main')
+        self.history.add('git commit')
+        self.assertEqual(self.history.latest('git c'), 'git commit')
+        self.history.zap('git commit')
+        self.assertEqual(self.history.latest('git c'), 'git checkout main')
+        self.assertEqual(self.history.latest('svn'), None)
+
+    def testAssignIterable(self):
+        self.history.list = iter(self.lines)
+        self.assertEqual(self.history.list, self.lines)
+        self.assertEqual(self.history.latest('git c'), 'git checkout main')
+
+    def testZap(self):
+        self.history.zap('make clean')
+        self.assertFalse('make clean' in self.history.list)
+        self.history.start('make')
+        self.assertEqual(self.history.filtered_list, [])
+        self.history.start('git')
+        self.assertEqual(self.history.filtered_list,
+                         reference_filter(self.history.list, 'git'))
+
+
+class TestLazyNavigation(TestCase):
+    lines = TestCommandHistory.lines
+    filters = TestCommandHistory.filters
+
+    def setUp(self):
+        self.history = CommandHistory()
+        self.history.list = list(self.lines)
+
+    def navigate(self):
+        """Navigate up to the end of the history, return the visited entries"""
+        visited = []
+        while self.history.up():
+            visited.append(self.history.current())
+        return visited
+
+    def testNavigationOrder(self):
+        """Lazy navigation visits the matches in the same order"""
+        for f in self.filters + ['g', 'gi', 'git', 'git c', 'git ch', 'cd', 'cd.']:
+            self.history.start(f)
+            self.assertEqual(self.navigate(), list(reversed(reference_filter(self.lines, f))), f)
+
+    def testFirstMatch(self):
+        """The strongest match is found without scanning the whole history"""
+        self.history.start('n')
+        self.assertTrue(self.history.up())
+        self.assertEqual(self.history.current()[0], 'notepad CommandHistory.py')
+        self.assertNotEqual(self.history._pending, None)
+
+    def testBackAndForth(self):
+        self.history.start('git c')
+        self.history.up()
+        self.history.up()
+        self.history.down()
+        self.history.up()
+        self.assertEqual(self.history.current()[0], 'echo "git checkout"')
+        self.assertEqual([l for (l, _) in self.navigate()],
+                         [l for (l, _) in reversed(reference_filter(self.lines, 'git c'))][2:])
+        self.assertFalse(self.history.up())
+
+
+class PausedHistory(CommandHistory):
+    """CommandHistory whose indexer waits until resumed"""
+    def __init__(self):
+        CommandHistory.__init__(self, lazy=False)
+        self.resume = threading.Event()
+
+    def _build_indexes(self, *args):
+        self.resume.wait()
+        CommandHistory._build_indexes(self, *args)
+
+
+class TestBackgroundIndex(TestCase):
+    def setUp(self):
+        rand = random.Random(0)
+        words = ['git', 'checkout', 'commit', 'make', 'clean', 'cd', '..', 'dir', '/s', 'main.c']
+        self.lines = [' '.join(rand.choice(words) for i in range(rand.randint(1, 4)))
+                      for j in range(300)]
+        self.history = PausedHistory()
+        self.history.background_index_size = 50
+        self.history.index_chunk_size = 20
+        self.history.list = list(self.lines)
+
+    def check(self):
+        """The searches and suggestions give the same results as the reference"""
+        lines = list(self.history.list)
+        for f in ['g', 'git c', 'make', 'cd .', 'xyz']:
+            self.history.start(f)
+            self.assertEqual(self.history.filtered_list, reference_filter(lines, f), f)
+        for prefix in ['', 'g', 'git c', 'make clean m', 'xyz']:
+            expected = [l for l in reversed(lines) if l.startswith(prefix)]
+            self.assertEqual(self.history.latest(prefix), expected[0] if expected else None)
+
+    def testIndexing(self):
+        """The lines are scanned until the index is built, then indexed"""
+        self.check()
+        self.assertFalse(self.history._indexed)
+        self.history.add('git commit -a')
+        self.history.zap(self.lines[-1])
+        self.history.add(self.lines[0])
+        self.history.resume.set()
+        self.history._indexer.join()
+        self.assertTrue(self.history._indexed)
+        self.check()
+
+    def testReplaced(self):
+        """An indexer stops when the list is replaced"""
+        indexer = self.history._indexer
+        self.history.list = self.lines[100:]
+        self.history.resume.set()
+        indexer.join()
+        self.history._indexer.join()
+        expected = CommandHistory()
+        expected.list = self.lines[100:]
+        self.assertEqual(self.history.list, expected.list)
+        self.check()
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryIndex))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryMatcher))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestPrefixTree))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCommandHistory))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestLazyNavigation))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestBackgroundIndex))
+    return suite
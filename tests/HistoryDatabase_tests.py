@@ -0,0 +1,144 @@
+#
+# Unit tests for HistoryDatabase.py
+#
+
+import os, codecs, tempfile, shutil, multiprocessing, sqlite3
+from unittest import TestCase, TestSuite, defaultTestLoader
+from HistoryDatabase import HistoryDatabase
+from HistoryFile import HistoryWriter
+
+def hammer(filename, process, count):
+    """Add lines to a shared history database (run in a separate process)"""
+    history = HistoryDatabase(filename, 4 * count + 3)
+    for i in range(count):
+        history.append([u'%d-%d' % (process, i), u'a', u'b', u'c'])
+
+
+class TestHistoryDatabase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def info(self, line):
+        """Return the information stored for a line (None if not present)"""
+        db = sqlite3.connect(self.filename + '.db')
+        row = db.execute('SELECT timestamp, cwd, exit_code, duration FROM history WHERE command = ?',
+                         (line,)).fetchone()
+        db.close()
+        if row is None:
+            return None
+        return dict(zip(['timestamp', 'cwd', 'exit_code', 'duration'], row))
+
+    def testHistory(self):
+        history = HistoryDatabase(self.filename, 10)
+        self.assertFalse(history.exists())
+        history.add(u'dir')
+        history.add(u'make')
+        history.add(u'git status')
+        history.add(u'dir')
+        history.remove(u'make')
+        self.assertTrue(history.exists())
+        self.assertEqual(HistoryDatabase(self.filename, 10).read(), [u'git status', u'dir'])
+        self.assertEqual(HistoryDatabase(self.filename, 1).read(), [u'dir'])
+
+    def testTruncation(self):
+        history = HistoryDatabase(self.filename, 3)
+        for line in [u'a', u'b', u'a', u'c', u'd', u'b', u'e']:
+            history.add(line)
+        self.assertEqual(HistoryDatabase(self.filename, None).read(), [u'd', u'b', u'e'])
+
+    def testCommandInfo(self):
+        history = HistoryDatabase(self.filename, 10)
+        history.add(u'make', {'timestamp': 1000.0, 'cwd': u'C:\\src', 'exit_code': 2, 'duration': 1.5})
+        history.add(u'dir', {'timestamp': 1002.0, 'cwd': u'C:\\', 'exit_code': 0, 'duration': 0.1})
+        history.add(u'make test', {'timestamp': 1003.0, 'cwd': u'C:\\src', 'exit_code': 0, 'duration': 9.0})
+        self.assertEqual(self.info(u'make'),
+                         {'timestamp': 1000.0, 'cwd': u'C:\\src', 'exit_code': 2, 'duration': 1.5})
+        self.assertEqual(self.info(u'make test')['cwd'], u'C:\\src')
+        self.assertEqual(self.info(u'svn'), None)
+
+    def testFsync(self):
+        """The sync policy is set when the database is opened"""
+        history = HistoryDatabase(self.filename, 10, fsync=True)
+        history.add(u'dir')
+        self.assertEqual(history.connection.execute('PRAGMA synchronous').fetchone()[0], 2)  # FULL
+        history = HistoryDatabase(self.filename, 10)
+        self.assertEqual(history.read(), [u'dir'])
+        self.assertEqual(history.connection.execute('PRAGMA synchronous').fetchone()[0], 1)  # NORMAL
+
+    def testImport(self):
+        """The history file of the file backend is imported"""
+        with codecs.open(self.filename, 'w', 'utf8') as f:
+            f.writelines([u'dir\n', u'make clean\n', u'echo é\n'])
+        history = HistoryDatabase(self.filename, 10)
+        self.assertEqual(history.read(), [u'dir', u'make clean', u'echo é'])
+        history.remove(u'dir')
+        self.assertEqual(HistoryDatabase(self.filename, 10).read(), [u'make clean', u'echo é'])
+
+    def testUpdate(self):
+        """Each instance only gets the lines added by the others"""
+        first = HistoryDatabase(self.filename, 10)
+        second = HistoryDatabase(self.filename, 10)
+        self.assertEqual(first.read(), [])
+        self.assertEqual(second.read(), [])
+        first.add(u'dir')
+        first.add(u'make')
+        second.add(u'git status')
+        self.assertEqual(second.update(), [u'dir', u'make', u'git status'])
+        self.assertEqual(second.update(), [])
+        self.assertEqual(first.update(), [u'git status'])
+        first.remove(u'dir')
+        self.assertEqual(first.update(), [])
+        self.assertEqual(second.update(), None)
+        self.assertEqual(second.read(), [u'make', u'git status'])
+
+    def testLocked(self):
+        """A locked database is reported as an IOError"""
+        history = HistoryDatabase(self.filename, 10)
+        history.lock_timeout = 0.1
+        history.add(u'dir')
+        other = sqlite3.connect(history.database, isolation_level=None)
+        other.execute('BEGIN EXCLUSIVE')
+        try:
+            self.assertRaises(IOError, history.read)
+            self.assertRaises(IOError, history.update)
+            self.assertRaises(IOError, history.add, u'make')
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+        self.assertEqual(history.update(), [])
+
+    def testWriter(self):
+        history = HistoryDatabase(self.filename, 10)
+        writer = HistoryWriter(delay=0.05)
+        writer.start()
+        writer.add(history, u'make', {'cwd': u'C:\\src', 'exit_code': 1})
+        writer.add(history, u'dir')
+        writer.add(history, u'make', {'cwd': u'C:\\', 'exit_code': 0})
+        writer.close()
+        self.assertEqual(writer.error, None)
+        self.assertEqual(history.read(), [u'dir', u'make'])
+        self.assertEqual(self.info(u'make')['cwd'], u'C:\\')
+
+    def testProcesses(self):
+        """Concurrent sessions don't lose each other's lines"""
+        processes = [multiprocessing.Process(target=hammer, args=(self.filename, p, 100))
+                     for p in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        lines = HistoryDatabase(self.filename, None).read()
+        self.assertEqual(sorted(lines),
+                         sorted([u'%d-%d' % (p, i) for p in range(4) for i in range(100)]
+                                + [u'a', u'b', u'c']))
+        self.assertEqual(lines[-3:], [u'a', u'b', u'c'])
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryDatabase))
+    return suite
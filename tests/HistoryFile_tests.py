@@ -0,0 +1,187 @@
+#
+# Unit tests for HistoryFile.py
+#
+
+import os, codecs, tempfile, shutil, multiprocessing
+from unittest import TestCase, TestSuite, defaultTestLoader
+from HistoryFile import HistoryFile, HistoryWriter, REMOVE_MARKER, coalesce
+
+class TestHistoryFile(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def records(self):
+        with codecs.open(self.filename, 'r', 'utf8') as f:
+            return [l.rstrip(u'\n') for l in f]
+
+    def testPlainFile(self):
+        """History files written before journaling load unchanged"""
+        with codecs.open(self.filename, 'w', 'utf8') as f:
+            f.writelines([u'dir\n', u'make clean\n', u'echo é\n'])
+        self.assertEqual(HistoryFile(self.filename, 10).read(), [u'dir', u'make clean', u'echo é'])
+
+    def testJournal(self):
+        history = HistoryFile(self.filename, 10)
+        history.add(u'dir')
+        history.add(u'make')
+        history.add(u'git status')
+        history.add(u'dir')
+        history.remove(u'make')
+        self.assertEqual(self.records(), [u'dir', u'make', u'git status', u'dir', REMOVE_MARKER + u'make'])
+        self.assertEqual(HistoryFile(self.filename, 10).read(), [u'git status', u'dir'])
+        self.assertEqual(HistoryFile(self.filename, 1).read(), [u'dir'])
+
+    def testCompaction(self):
+        history = HistoryFile(self.filename, 3)
+        for line in [u'a', u'b', u'a', u'c', u'd', u'b']:
+            history.add(line)
+        self.assertEqual(len(self.records()), 6)
+        history.remove(u'x')
+        self.assertEqual(self.records(), [u'c', u'd', u'b'])
+        self.assertEqual(history.records, 3)
+        history.add(u'e')
+        self.assertEqual(HistoryFile(self.filename, 3).read(), [u'd', u'b', u'e'])
+
+    def testExistingJournal(self):
+        """Appending to a journal written by an earlier session"""
+        HistoryFile(self.filename, 2).add(u'a')
+        history = HistoryFile(self.filename, 2)
+        for line in [u'b', u'c', u'd']:
+            history.add(line)
+        self.assertEqual(self.records(), [u'a', u'b', u'c', u'd'])
+        history.add(u'e')
+        self.assertEqual(self.records(), [u'd', u'e'])
+
+
+def hammer(filename, process, count):
+    """Add lines to a shared history file (run in a separate process)"""
+    history = HistoryFile(filename, 4 * count + 3)
+    for i in range(count):
+        history.append([u'%d-%d' % (process, i), u'a', u'b', u'c'])
+
+
+class TestSharedHistory(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testUpdate(self):
+        """Each instance only replays the records appended by the others"""
+        first = HistoryFile(self.filename, 10)
+        second = HistoryFile(self.filename, 10)
+        self.assertEqual(first.read(), [])
+        self.assertEqual(second.read(), [])
+        first.add(u'dir')
+        first.add(u'make')
+        second.add(u'git status')
+        first.remove(u'dir')
+        self.assertEqual(second.update(), [u'dir', u'make', u'git status', REMOVE_MARKER + u'dir'])
+        self.assertEqual(second.update(), [])
+        self.assertEqual(first.update(), [u'git status', REMOVE_MARKER + u'dir'])
+        self.assertEqual(second.read(), [u'make', u'git status'])
+
+    def testUpdateAfterCompaction(self):
+        first = HistoryFile(self.filename, 2)
+        second = HistoryFile(self.filename, 2)
+        first.add(u'a')
+        self.assertEqual(second.read(), [u'a'])
+        for line in [u'b', u'c', u'd', u'e']:
+            first.add(line)
+        self.assertEqual(second.update(), None)
+        self.assertEqual(second.read(), [u'd', u'e'])
+        first.add(u'f')
+        self.assertEqual(second.update(), [u'f'])
+
+    def testProcesses(self):
+        """Concurrent sessions don't lose each other's records"""
+        processes = [multiprocessing.Process(target=hammer, args=(self.filename, p, 100))
+                     for p in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        lines = HistoryFile(self.filename, None).read()
+        self.assertEqual(sorted(lines),
+                         sorted([u'%d-%d' % (p, i) for p in range(4) for i in range(100)]
+                                + [u'a', u'b', u'c']))
+        self.assertEqual(lines[-3:], [u'a', u'b', u'c'])
+        for p in range(4):
+            self.assertEqual([l for l in lines if l.startswith(u'%d-' % p)],
+                             [u'%d-%d' % (p, i) for i in range(100)])
+
+
+class TestHistoryWriter(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.history = HistoryFile(os.path.join(self.dir, 'history'), 100)
+        self.dir_history = HistoryFile(os.path.join(self.dir, 'dir_history'), 100)
+        self.writer = HistoryWriter(delay=0.05)
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def testCoalesce(self):
+        self.assertEqual(coalesce([u'a', u'b', u'a', REMOVE_MARKER + u'b', u'c']),
+                         [u'a', REMOVE_MARKER + u'b', u'c'])
+
+    def testFlush(self):
+        self.writer.add(self.history, u'dir')
+        self.writer.add(self.dir_history, u'c:\\')
+        self.writer.add(self.history, u'make')
+        self.writer.add(self.history, u'dir')
+        self.writer.remove(self.history, u'make')
+        self.writer.flush()
+        self.assertEqual(self.history.records, 2)
+        self.assertEqual(HistoryFile(self.history.filename, 100).read(), [u'dir'])
+        self.assertEqual(HistoryFile(self.dir_history.filename, 100).read(), [u'c:\\'])
+
+    def testClose(self):
+        """Closing the writer saves the pending records"""
+        self.writer.delay = 10
+        self.writer.add(self.history, u'dir')
+        self.writer.close()
+        self.assertFalse(self.writer.is_alive())
+        self.assertEqual(HistoryFile(self.history.filename, 100).read(), [u'dir'])
+
+    def testError(self):
+        """The writer keeps running after an error"""
+        missing = HistoryFile(os.path.join(self.dir, 'missing', 'history'), 100)
+        self.writer.add(missing, u'dir')
+        self.writer.flush(5)
+        self.assertTrue(isinstance(self.writer.error, (IOError, OSError)))
+        self.writer.add(self.history, u'dir')
+        self.writer.flush(5)
+        self.assertTrue(self.writer.is_alive())
+        self.assertEqual(HistoryFile(self.history.filename, 100).read(), [u'dir'])
+
+    def testUnencodable(self):
+        """A line that can't be encoded doesn't lose the others"""
+        self.writer.add(self.history, u'echo \ud83d')
+        self.writer.add(self.history, u'dir')
+        self.writer.flush(5)
+        self.assertEqual(self.writer.error, None)
+        self.assertEqual(HistoryFile(self.history.filename, 100).read(), [u'echo ?', u'dir'])
+
+    def testFsync(self):
+        self.writer.fsync = True
+        self.writer.add(self.history, u'dir')
+        self.writer.flush()
+        self.assertEqual(HistoryFile(self.history.filename, 100).read(), [u'dir'])
+        self.assertEqual(self.writer.error, None)
+
+
+def suite():
+    suite = TestSuite()
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryFile))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestSharedHistory))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestHistoryWriter))
+    return suite
@@ -2,6 +2,7 @@
 # Unit tests for console.py
 #
 
+import os, tempfile, shutil
 from unittest import TestCase, TestSuite, defaultTestLoader
 from InputState import InputState
 
@@ -37,6 +38,48 @@ class TestInputState(TestCase):
         self.state.update_suggestion()
         self.assertEqual(self.state.suggestion, '')
 
+    def testSuggestFromFiles(self):
+        """File names are suggested once completed in the background"""
+        directory = tempfile.mkdtemp()
+        open(os.path.join(directory, 'readme.txt'), 'w').close()
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            self.state.history.list = []
+            self.state.suggestion_delay = 0
+            self.state.before_cursor = 'type rea'
+            self.state.update_suggestion()
+            self.assertEqual(self.state.suggestion, '')
+            self.assertTrue(self.state.suggestion_request.wait(5))
+            self.assertTrue(self.state.apply_suggestion())
+            self.assertEqual(self.state.suggestion, 'dme.txt ')
+
+            # Results for a line that changed meanwhile are dropped
+            self.state.suggestion = ''
+            self.state.update_suggestion()
+            self.assertTrue(self.state.suggestion_request.wait(5))
+            self.state.before_cursor = 'type read'
+            self.assertTrue(self.state.apply_suggestion())
+            self.assertEqual(self.state.suggestion, '')
+            self.assertEqual(self.state.suggestion_request, None)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+    def testDebounce(self):
+        """Only the completion for the last edit is computed"""
+        self.state.history.list = []
+        self.state.suggestion_delay = 5
+        self.state.before_cursor = 'type rea'
+        self.state.update_suggestion()
+        first = self.state.suggestion_request
+        self.state.before_cursor = 'type read'
+        self.state.update_suggestion()
+        self.assertTrue(first.wait(1))
+        self.assertEqual(first.result, None)
+        self.assertFalse(self.state.apply_suggestion())
+        self.state.completer.cancel()
+
     def testAvoidDuplicateFillers(self):
         """Tests the avoidance of duplicate whitespace, backslash, quites after completing"""
         self.state.before_cursor = '"c:\\Program Files (x86)\\Sysinternals Suite'
@@ -1,11 +1,13 @@
 #
 # Unit tests for common.py
 #
-import os
+import os, time, tempfile, shutil, threading, random
 from unittest import TestCase, TestSuite, defaultTestLoader
-from common import parse_line, escape_special_chars_in_quotes, unescape, fuzzy_match
+import common
+from common import parse_line, parse_line_fsm, escape_special_chars_in_quotes, unescape, fuzzy_match
 from common import associated_application, full_executable_path, is_gui_application
-from common import abbrev_tilde
+from common import abbrev_tilde, ExecutableIndex, line_fsm, line_parser, tokenize, LineTokenizer
+from common import parse_line_spans, tokenize_spans, Token, TOKEN_WORD, TOKEN_SEQ, TOKEN_REDIR
 
 class TestParseLine(TestCase):
 
@@ -201,6 +203,44 @@ class TestParseLine(TestCase):
             second_parse = parse_line(' '.join(first_parse))
             self.assertEqual(first_parse, second_parse)
 
+    def testScannerMatchesFSM(self):
+        """The compiled scanner tokenizes random lines like the parser FSM"""
+        rand = random.Random(0)
+        alphabet = ' \t"|&<>^0129aZ.\\'
+        for i in range(20000):
+            line = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 16)))
+            self.assertEqual(parse_line(line), parse_line_fsm(line), line)
+        for input, expected in self.lines_to_parse:
+            self.assertEqual(parse_line_fsm(input), expected)
+
+    def testSharedMachine(self):
+        """The parses run on copies of a single machine, with their own memory"""
+        first = parse_line('dir a | more')
+        second = parse_line('dir b')
+        self.assertEqual(first, ['dir', 'a', '|', 'more'])
+        self.assertEqual(second, ['dir', 'b'])
+        copy = line_fsm.copy([''])
+        self.assertTrue(copy.state_transitions is line_fsm.state_transitions)
+        self.assertEqual(copy.current_state, 'init')
+        self.assertEqual(line_fsm.memory, None)
+
+    def testFrozenMachine(self):
+        """The frozen machine goes through the same states and tokens"""
+        self.assertTrue(line_fsm.frozen_transitions is not None)
+        rand = random.Random(0)
+        alphabet = ' \t"|&<>^0129aZ.\\'
+        for i in range(500):
+            line = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 30)))
+            frozen = line_fsm.copy([''])
+            unfrozen = line_parser()
+            unfrozen.memory = ['']
+            for c in line:
+                frozen.process(c)
+                unfrozen.process(c)
+                self.assertEqual((frozen.current_state, frozen.memory),
+                                 (unfrozen.current_state, unfrozen.memory), line)
+            self.assertEqual(parse_line_fsm(line), parse_line(line), line)
+
     def testUnescape(self):
         """Test that result of unescape equals expected result."""
         for input, expected in self.strings_to_unescape:
@@ -213,6 +253,72 @@ class TestParseLine(TestCase):
 
 
 
+class TestLineTokenizer(TestCase):
+    def testEdits(self):
+        """Random edits are tokenized like the whole line"""
+        rand = random.Random(0)
+        alphabet = ' \t"|&<>^0129aZ.\\'
+        for i in range(300):
+            tokenizer = LineTokenizer()
+            line = ''
+            for j in range(30):
+                pos = rand.randint(0, len(line))
+                if rand.random() < 0.7:
+                    line = line[:pos] + rand.choice(alphabet) + line[pos:]
+                else:
+                    line = line[:pos] + line[pos + 1:]
+                self.assertEqual(tokenizer.tokenize(line), tokenize(line), line)
+                self.assertEqual(tokenizer.tokenize_spans(line), tokenize_spans(line), line)
+
+    def testRescanFromBoundary(self):
+        """Only the last token is scanned again when it is edited"""
+        tokenizer = LineTokenizer()
+        tokenizer.tokenize('dir /s "C:\\Program Files" | more')
+        scanned = []
+        scan = common.line_scanner.scan
+        def record_scan(line, pos=0, *args):
+            scanned.append(pos)
+            return scan(line, pos, *args)
+        common.line_scanner.scan = record_scan
+        try:
+            self.assertEqual(tokenizer.tokenize('dir /s "C:\\Program Files" | mor'),
+                             ['dir', '/s', '"C:\\Program Files"', '|', 'mor'])
+        finally:
+            del common.line_scanner.scan
+        self.assertEqual(scanned, [len('dir /s "C:\\Program Files" | ')])
+
+
+class TestTokenSpans(TestCase):
+    def testSpans(self):
+        """The records hold the tokens, their position in the line and their kind"""
+        line = 'dir  "C:\\Program Files" 2>&1|more >out.txt'
+        self.assertEqual(tokenize_spans(line),
+                         [Token('dir', 0, 3, TOKEN_WORD),
+                          Token('"C:\\Program Files"', 5, 23, TOKEN_WORD),
+                          Token('2>&1', 24, 28, TOKEN_REDIR),
+                          Token('|', 28, 29, TOKEN_SEQ),
+                          Token('more', 29, 33, TOKEN_WORD),
+                          Token('>', 34, 35, TOKEN_REDIR),
+                          Token('out.txt', 35, 42, TOKEN_WORD)])
+        self.assertEqual(tokenize_spans('dir && '),
+                         [Token('dir', 0, 3, TOKEN_WORD),
+                          Token('&&', 4, 6, TOKEN_SEQ),
+                          Token('', 7, 7, TOKEN_WORD)])
+        self.assertEqual(tokenize_spans(''), [Token('', 0, 0, TOKEN_WORD)])
+
+    def testMatchesTokens(self):
+        """The records slice the line into the same tokens as tokenize()"""
+        rand = random.Random(0)
+        alphabet = ' \t"|&<>^0129aZ.\\'
+        for i in range(2000):
+            line = ''.join(rand.choice(alphabet) for j in range(rand.randint(0, 20)))
+            spans = parse_line_spans(line)
+            self.assertEqual([token.text for token in spans], parse_line(line), line)
+            for token in spans:
+                self.assertEqual(line[token.start:token.end], token.text, line)
+            self.assertEqual([token.text for token in tokenize_spans(line)], tokenize(line), line)
+
+
 class TestFuzzyMatch(TestCase):
     match_tests = [
         ('first', 'this first line will match first', [(5, 10)]),
@@ -285,11 +391,115 @@ class TestPathManipulation(TestCase):
         self.assertEqual(abbrev_tilde(os.path.expanduser(r'~\pycmd')), r'~\pycmd')
         self.assertEqual(abbrev_tilde(r'C:\Windows'), r'C:\Windows')
 
+class TestExecutableIndex(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dirs = [os.path.join(self.dir, d) for d in ['bin', 'tools']]
+        for d, names in zip(self.dirs, [['make.exe', 'build.bat', 'README.txt'],
+                                         ['make.cmd', 'grep.EXE']]):
+            os.mkdir(d)
+            for name in names:
+                open(os.path.join(d, name), 'w').close()
+            self.age(d)
+        os.mkdir(os.path.join(self.dirs[0], 'sub.exe'))
+        self.age(self.dirs[0])
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join(self.dirs)
+        os.environ['PATHEXT'] = os.pathsep.join(['.COM', '.EXE', '.BAT', '.CMD'])
+        self.filename = os.path.join(self.dir, 'executables.json')
+        self.index = ExecutableIndex(self.filename)
+
+    def tearDown(self):
+        self.index.flush()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def age(self, path):
+        """Pretend a file or directory was last modified a minute ago"""
+        past = time.time() - 60
+        os.utime(path, (past, past))
+
+    def executables(self, index):
+        (listings, complete) = index.executables()
+        self.assertTrue(complete)
+        return [(d, sorted(names)) for (d, names) in listings]
+
+    def testExecutables(self):
+        self.assertEqual(self.executables(self.index),
+                         [(self.dirs[0], ['build.bat', 'make.exe']),
+                          (self.dirs[1], ['grep.EXE', 'make.cmd'])])
+
+    def testFind(self):
+        self.assertEqual(self.index.find('make', ['.exe', '.cmd']), os.path.join(self.dirs[0], 'make.exe'))
+        self.assertEqual(self.index.find('make', ['.cmd', '.exe']), os.path.join(self.dirs[0], 'make.exe'))
+        self.assertEqual(self.index.find('make', ['.cmd']), os.path.join(self.dirs[1], 'make.cmd'))
+        self.assertEqual(self.index.find('grep', ['.exe']), os.path.join(self.dirs[1], 'grep.exe'))
+        self.assertEqual(self.index.find('README', ['.txt']), None)
+        self.assertEqual(self.index.find('sub', ['.exe']), None)
+
+    def testModified(self):
+        """Directories are listed again when they change"""
+        self.index.executables()
+        open(os.path.join(self.dirs[1], 'sed.exe'), 'w').close()
+        self.assertEqual(self.executables(self.index)[1], (self.dirs[1], ['grep.EXE', 'make.cmd', 'sed.exe']))
+        os.environ['PATHEXT'] = '.EXE'
+        self.assertEqual(self.executables(self.index)[0], (self.dirs[0], ['make.exe']))
+        os.environ['PATH'] = self.dirs[1]
+        self.assertEqual([d for (d, _) in self.index.executables()[0]], [self.dirs[1]])
+
+    def testSaved(self):
+        """The index of a previous session is reused"""
+        self.index.executables()
+        self.index.flush()
+        # Not noticed, the modification time is unchanged
+        stat = os.stat(self.dirs[0])
+        os.remove(os.path.join(self.dirs[0], 'build.bat'))
+        os.utime(self.dirs[0], (stat.st_atime, stat.st_mtime))
+        index = ExecutableIndex(self.filename)
+        self.assertEqual(self.executables(index)[0], (self.dirs[0], ['build.bat', 'make.exe']))
+        self.assertEqual(index.find('grep', ['.exe']), os.path.join(self.dirs[1], 'grep.exe'))
+
+    def testRacy(self):
+        """Recently modified directories are listed again, but not saved again if unchanged"""
+        open(os.path.join(self.dirs[1], 'sed.exe'), 'w').close()
+        self.index.executables()
+        self.index.flush()
+        self.age(self.filename)
+        saved = os.path.getmtime(self.filename)
+        self.assertEqual(self.executables(self.index)[1], (self.dirs[1], ['grep.EXE', 'make.cmd', 'sed.exe']))
+        self.index.flush()
+        self.assertEqual(os.path.getmtime(self.filename), saved)
+        os.remove(os.path.join(self.dirs[1], 'sed.exe'))
+        self.assertEqual(self.executables(self.index)[1], (self.dirs[1], ['grep.EXE', 'make.cmd']))
+        self.index.flush()
+        index = ExecutableIndex(self.filename)
+        self.assertEqual(self.executables(index)[1], (self.dirs[1], ['grep.EXE', 'make.cmd']))
+
+    def testTimeout(self):
+        """Slow directories are left out when the timeout expires"""
+        slow = threading.Event()
+        list_dir = self.index._list
+        def list_slowly(d, pathext):
+            if d == self.dirs[0]:
+                slow.wait(10)
+            list_dir(d, pathext)
+        self.index._list = list_slowly
+        (listings, complete) = self.index.executables(timeout=0.1)
+        self.assertFalse(complete)
+        self.assertEqual([d for (d, _) in listings], [self.dirs[1]])
+        slow.set()
+        self.assertEqual(len(self.executables(self.index)), 2)
+
+
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestParseLine))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestLineTokenizer))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestTokenSpans))
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestFuzzyMatch))
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestAppIdentification))
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestPathManipulation))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestExecutableIndex))
     return suite
 
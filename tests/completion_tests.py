@@ -2,8 +2,14 @@
 # Unit tests for completion.py
 #
 
+import os, re, time, tempfile, shutil, threading, random
 from unittest import TestCase, TestSuite, defaultTestLoader
-from completion import wildcard_to_regex, find_common_prefix
+from completion import wildcard_to_regex, find_common_prefix, DirectoryCache, DirEntry
+from completion import complete, complete_file, strip_exec_extensions, CompletionLine
+from completion import Completer
+from common import strip_extension, has_exec_extension
+from common import ExecutableIndex
+import completion
 
 class TestWildcardMatching(TestCase):
     matches = [
@@ -35,6 +41,28 @@ class TestWildcardMatching(TestCase):
             else:
                 self.assertEqual(None, groups)
 
+    def reference(self, pattern):
+        """
+        The regex translation of the pattern by escaping the special
+        characters one after the other, as wildcard_to_regex() used to
+        """
+        re_pattern = pattern
+        for src, dest in [('\\', '\\\\'), ('(', '\\('), (')', '\\)'), ('[', '\\['), (']', '\\]'),
+                          ('.', '\\.'), ('+', '\\+'), ('^', '\\^'), ('$', '\\$'),
+                          ('?', '(.)'), ('*', '(.*)')]:
+            re_pattern = re_pattern.replace(src, dest)
+        return re.compile(re_pattern + '$', re.IGNORECASE)
+
+    def testCached(self):
+        self.assertTrue(wildcard_to_regex('ab*') is wildcard_to_regex('ab*'))
+
+    def testTranslation(self):
+        """Same regexes as escaping the special characters one after the other"""
+        rand = random.Random(0)
+        for i in range(1000):
+            pattern = ''.join(rand.choice('a\\()[].+^$?*') for j in range(rand.randint(0, 8)))
+            self.assertEqual(wildcard_to_regex(pattern).pattern, self.reference(pattern).pattern)
+
 
 class TestFindCommonPrefix(TestCase):
     results = [
@@ -52,9 +80,302 @@ class TestFindCommonPrefix(TestCase):
         for original, completions, result in self.results:
             self.assertEqual(find_common_prefix(original, completions), result)
 
+    def reference(self, original, completions):
+        """Grow the prefix one character at a time, then guess the case"""
+        common_len = 0
+        common_string = ''
+        mismatch = False
+        perfect = True
+        completions_lower = [s.lower() for s in completions]
+        while common_len < len(completions[0]) and not mismatch:
+            common_len += 1
+            common_string = completions[0][0:common_len]
+            for i in range(1, len(completions)):
+                if completions_lower[i][0:common_len] != completions_lower[0][0:common_len]:
+                    mismatch = True
+                elif completions[i][0:common_len] != common_string:
+                    perfect = False
+        if mismatch:
+            common_string = common_string[:-1]
+            common_len -= 1
+        if not perfect:
+            for i in range(len(original)):
+                case_match = [c for c in completions if c.startswith(original[:i + 1])]
+                if len(case_match) > 0:
+                    common_string = case_match[0][:common_len]
+                else:
+                    break
+        return common_string
+
+    def testRandomized(self):
+        rand = random.Random(0)
+        chars = 'aAbB.\u0130\u0131iI'
+        for i in range(20000):
+            completions = [''.join(rand.choice(chars) for j in range(rand.randint(0, 5)))
+                           for k in range(rand.randint(1, 5))]
+            original = rand.choice(completions)[:rand.randint(0, 4)]
+            if rand.random() < 0.5:
+                original = original.swapcase() + rand.choice(chars)
+            self.assertEqual(find_common_prefix(original, completions),
+                             self.reference(original, completions), (original, completions))
+
+
+class TestStripExecExtensions(TestCase):
+    def reference(self, completions_path, completions, prefix):
+        """The original (quadratic) computation of the nice names"""
+        completions_path_no_ext = [strip_extension(elem) for elem in completions_path]
+        completions_path_nice = []
+        for i in range(0, len(completions_path_no_ext)):
+            similar = [elem for elem in completions_path_no_ext if elem == completions_path_no_ext[i]]
+            similar += [elem for elem in completions if strip_extension(elem) == completions_path_no_ext[i]]
+            if len(similar) == 1 and has_exec_extension(completions_path[i]) and len(prefix) < len(completions_path[i]) - 3:
+                completions_path_nice.append(completions_path_no_ext[i])
+            else:
+                completions_path_nice.append(completions_path[i])
+        return completions_path_nice
+
+    def testNiceNames(self):
+        self.assertEqual(strip_exec_extensions(['git.exe', 'gitk.bat', 'gitk.exe', 'goto'],
+                                               ['git.txt', 'gui\\'], 'g'),
+                         ['git.exe', 'gitk.bat', 'gitk.exe', 'goto'])
+        self.assertEqual(strip_exec_extensions(['make.exe', 'mklink'], [], 'm'), ['make', 'mklink'])
+        self.assertEqual(strip_exec_extensions(['make.exe'], [], 'make.'), ['make.exe'])
+
+    def testRandomized(self):
+        """Same results as the original computation"""
+        rand = random.Random(0)
+        for i in range(200):
+            names = [''.join(rand.choice('ab') for j in range(rand.randint(1, 3)))
+                     + rand.choice(['', '.exe', '.bat', '.txt', '\\'])
+                     for j in range(rand.randint(0, 30))]
+            completions_path = sorted(set(names[:len(names) // 2]), key=str.lower)
+            completions = names[len(names) // 2:]
+            prefix = rand.choice(['', 'a', 'ab', 'aba'])
+            self.assertEqual(strip_exec_extensions(completions_path, completions, prefix),
+                             self.reference(completions_path, completions, prefix))
+
+
+class TestDirectoryCache(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = DirectoryCache(max_dirs=2, max_entries=5)
+        self.dirs = []
+        for name in ['a', 'b', 'c']:
+            path = os.path.join(self.dir, name)
+            os.mkdir(path)
+            os.mkdir(os.path.join(path, 'sub'))
+            open(os.path.join(path, 'file.txt'), 'w').close()
+            self.age(path)
+            self.dirs.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def age(self, path):
+        """Pretend a directory was last modified a minute ago"""
+        past = time.time() - 60
+        os.utime(path, (past, past))
+
+    def testListing(self):
+        (listing, complete) = self.cache.list(self.dirs[0])
+        self.assertTrue(complete)
+        self.assertEqual(sorted(listing),
+                         [DirEntry('file.txt', False, True), DirEntry('sub', True, False)])
+        self.assertTrue(self.cache.list(self.dirs[0] + os.sep)[0] is listing)
+
+    def testModified(self):
+        """Listings are refreshed when the directory changes"""
+        (listing, _) = self.cache.list(self.dirs[0])
+        open(os.path.join(self.dirs[0], 'new.txt'), 'w').close()
+        self.assertEqual(len(self.cache.list(self.dirs[0])[0]), 3)
+        self.assertFalse(self.cache.list(self.dirs[0])[0] is listing)
+
+    def testRecentlyModified(self):
+        """Listings of directories modified just now are not cached"""
+        open(os.path.join(self.dirs[0], 'new.txt'), 'w').close()
+        (listing, _) = self.cache.list(self.dirs[0])
+        self.assertFalse(self.cache.list(self.dirs[0])[0] is listing)
+
+    def testEviction(self):
+        (listing, _) = self.cache.list(self.dirs[0])
+        self.cache.list(self.dirs[1])
+        self.cache.list(self.dirs[0])
+        self.cache.list(self.dirs[2])
+        self.assertEqual(len(self.cache.listings), 2)
+        self.assertTrue(self.cache.list(self.dirs[0])[0] is listing)
+        self.cache.max_entries = 3
+        self.cache.list(self.dirs[1])
+        self.assertEqual(len(self.cache.listings), 1)
+        self.assertEqual(self.cache.entries, 2)
+
+    def testMissing(self):
+        self.assertRaises(OSError, self.cache.list, os.path.join(self.dir, 'missing'))
+
+
+class TestCompletionDeadline(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dirs = [os.path.join(self.dir, d) for d in ['slow', 'fast']]
+        for d, name in zip(self.dirs, ['zzslow.exe', 'zzfast.exe']):
+            os.mkdir(d)
+            open(os.path.join(d, name), 'w').close()
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = os.pathsep.join(self.dirs)
+        os.environ['PATHEXT'] = os.pathsep.join(['.EXE', '.BAT'])
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+        # PATH index with a directory that takes a while to list
+        self.slow = threading.Event()
+        self.index = ExecutableIndex()
+        list_dir = self.index._list
+        def list_slowly(d, pathext):
+            if d == self.dirs[0]:
+                self.slow.wait(10)
+            list_dir(d, pathext)
+        self.index._list = list_slowly
+        self.executable_index = completion.executable_index
+        completion.executable_index = self.index
+
+    def tearDown(self):
+        self.slow.set()
+        completion.executable_index = self.executable_index
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def testIncomplete(self):
+        (completed, completions) = complete_file('zz', timeout=0.1)
+        self.assertEqual(completions, ['zzfast'])
+        self.assertTrue(completions.incomplete)
+        # The missing completions might not share the prefix, the line is
+        # left as typed
+        self.assertEqual(completed, 'zz')
+        self.slow.set()
+        (completed, completions) = complete_file('zz', timeout=5)
+        self.assertEqual(completions, ['zzfast', 'zzslow'])
+        self.assertFalse(completions.incomplete)
+        self.assertEqual(completed, 'zz')
+        (completed, completions) = complete_file('zzf', timeout=5)
+        self.assertEqual(completed, 'zzfast ')
+
+
+class TestCompletionPipeline(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ['alpha', 'Alpha Beta', 'ab.txt']:
+            open(os.path.join(self.dir, name), 'w').close()
+        os.mkdir(os.path.join(self.dir, 'abc'))
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+        # Count the directory listings
+        self.listed = []
+        self.list_dir = completion.dir_cache.list
+        def list_dir(path, timeout=None):
+            self.listed.append(path)
+            return self.list_dir(path, timeout)
+        completion.dir_cache.list = list_dir
+
+    def tearDown(self):
+        del completion.dir_cache.list
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def testListedOnce(self):
+        """The alternate completion reuses the listing of the simple one"""
+        self.assertEqual(complete_file('dir zz'), ('dir zz', []))
+        self.assertEqual(len(self.listed), 1)
+        (completed, completions) = complete_file('set X=alpha;ab')
+        self.assertEqual(completed, 'set X=alpha;ab')
+        self.assertEqual(sorted(completions), ['ab.txt', 'abc\\'])
+        self.assertEqual(len(self.listed), 2)
+
+    def testQuoting(self):
+        (completed, completions) = complete_file('notepad al')
+        self.assertEqual(completed, 'notepad "alpha')
+        self.assertEqual(sorted(completions), ['Alpha Beta', 'alpha'])
+        self.assertEqual(complete_file('notepad "Alpha B'), ('notepad "Alpha Beta" ', ['Alpha Beta']))
+        self.assertEqual(complete_file('set X=alpha;"Alpha B'), ('set X="alpha;Alpha Beta', ['Alpha Beta']))
+        self.assertEqual(complete('dir a?c'), ('dir abc\\', ['abc\\']))
+        self.assertEqual(complete('dir a*.txt'), ('dir ab.txt ', ['ab.txt']))
+
+    def testMatchedOnce(self):
+        parsed = CompletionLine('dir a')
+        (entries, complete) = parsed.match(self.dir, 'a')
+        self.assertTrue(complete)
+        self.assertEqual(sorted(e.name for e in entries), ['Alpha Beta', 'ab.txt', 'abc', 'alpha'])
+        self.assertTrue(parsed.match(self.dir, 'a')[0] is entries)
+        self.assertEqual(sorted(e.name for e in parsed.match(self.dir, 'al')[0]), ['Alpha Beta', 'alpha'])
+        self.assertEqual(len(self.listed), 1)
+
+
+class TestCompleter(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ['alpha', 'beta']:
+            os.mkdir(os.path.join(self.dir, name))
+            open(os.path.join(self.dir, name, name + '.txt'), 'w').close()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.completer = Completer()
+
+        # Listing the alpha directory blocks until released
+        self.release = threading.Event()
+        self.listing = threading.Event()
+        list_dir = completion.dir_cache.list
+        def list_slowly(path, timeout=None):
+            if 'alpha' in path:
+                self.listing.set()
+                self.release.wait(10)
+            return list_dir(path, timeout)
+        completion.dir_cache.list = list_slowly
+
+    def tearDown(self):
+        self.release.set()
+        del completion.dir_cache.list
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def testResult(self):
+        request = self.completer.request('type beta/')
+        self.assertTrue(request.wait(5))
+        self.assertEqual(request.get(), ('type beta/beta.txt ', ['beta.txt']))
+        self.assertTrue(request.valid('type beta/'))
+        self.assertFalse(request.valid('type beta/b'))
+
+    def testCancelStale(self):
+        """A new request cancels the pending one, whose result is dropped"""
+        stale = self.completer.request('type alpha/')
+        self.assertTrue(self.listing.wait(5))
+        request = self.completer.request('type beta/')
+        self.assertTrue(stale.cancelled.is_set())
+        self.release.set()
+        self.assertTrue(request.wait(5))
+        self.assertEqual(request.get(), ('type beta/beta.txt ', ['beta.txt']))
+        self.assertTrue(stale.wait(5))
+        self.assertFalse(stale.valid('type alpha/'))
+
+    def testCancelQueued(self):
+        """Requests cancelled before they are started are skipped"""
+        self.completer.request('type alpha/')
+        self.assertTrue(self.listing.wait(5))
+        queued = self.completer.request('type beta/')
+        self.completer.cancel()
+        self.release.set()
+        self.assertTrue(queued.wait(5))
+        self.assertEqual(queued.result, None)
+        self.assertFalse(queued.valid('type beta/'))
+
 
 def suite():
     suite = TestSuite()
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestWildcardMatching))
     suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestFindCommonPrefix))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestStripExecExtensions))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestDirectoryCache))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCompletionDeadline))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCompletionPipeline))
+    suite.addTest(defaultTestLoader.loadTestsFromTestCase(TestCompleter))
     return suite